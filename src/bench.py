@@ -0,0 +1,401 @@
+#! /usr/bin/env python3
+#  bench.py
+#
+# Benchmarks for the META-II engines in meta.py (metaii.py).
+#
+# Every input is generated here, the same way each time, so that results
+# from different runs (and different versions of meta.py) can be compared.
+#
+#   ./bench.py -o now.json                 run, and save the results
+#   ./bench.py --compare base.json         run, and compare with a baseline
+#   ./bench.py --compare base.json now.json   just compare two saved runs
+#   ./bench.py --pairs                     count the instruction pairs run
+
+import argparse
+import collections
+import datetime
+import inspect
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import meta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+META_PY = os.path.join(HERE, "meta.py")
+
+ENGINES = ("py", "vm", "native")
+THRESHOLD = 10.0  # percent, beyond which a change is a regression
+
+
+#----- INPUTS ------------------------------------------------------------------
+
+def read_source(name):
+    with open(os.path.join(HERE, name)) as f:
+        return f.read()
+
+def valgol_program(statements):
+    """A VALGOL program of about this many statements"""
+    lines = [".BEGIN", "    .VAR X, Y;", "    0 = X"]
+    for i in range(statements // 2):
+        lines.append("    ; .UNTIL X .= %d .DO .BEGIN EDIT( X+(Y+%d), '*'); PRINT; X + 1 = X .END" % (i, i))
+        lines.append("    ; .IF X .= Y .THEN Y + 1 = Y .ELSE ((X)) = Y")
+    lines.append(".END")
+    return "\n".join(lines) + "\n"
+
+def valgol_nesting(depth, statements):
+    """A VALGOL program of deeply parenthesised expressions"""
+    expr = "(" * depth + "X + 1" + ")" * depth
+    lines = [".BEGIN", "    .VAR X;", "    0 = X"]
+    for i in range(statements):
+        lines.append("    ; %s = X" % expr)
+    lines.append(".END")
+    return "\n".join(lines) + "\n"
+
+def alternatives_spec(count):
+    """A grammar with one rule of many alternatives"""
+    alts = ["'k%03d' .OUT('A%03d')" % (i, i) for i in range(count)]
+    return ".SYNTAX S\nS = $ T '.END' ;\nT =\n    " + \
+           "\n  / ".join(alts) + "\n    ;\n.END\n"
+
+def alternatives_input(count, words):
+    """Keywords for alternatives_spec(count), mostly from late alternatives"""
+    picks = ["k%03d" % ((i * 37) % count) for i in range(words)]
+    lines = [" ".join(picks[i:i+16]) for i in range(0, len(picks), 16)]
+    return "\n".join(lines) + "\n.END\n"
+
+def nested_spec(depth, rules):
+    """A grammar whose rules nest parentheses this deep"""
+    body = "(" * depth + " 'a' .OUT('A') " + ")" * depth
+    text = ".SYNTAX R0\n"
+    for i in range(rules):
+        text += "R%d = %s / 'b' .OUT('B') ;\n" % (i, body)
+    return text + ".END\n"
+
+def make_cases(scale):
+    """name -> (program source (a .spec), or None for meta.spec, input)"""
+    valgol = read_source("valgol1.spec")
+    program = valgol_program(scale)
+    return {
+        "self":          (None,   read_source("meta.spec")),
+        "spec-alts":     (None,   alternatives_spec(300)),
+        "spec-nesting":  (None,   nested_spec(40, max(1, scale // 10))),
+        "valgol":        (valgol, program),
+        "valgol-1line":  (valgol, program.replace("\n", " ")),
+        "valgol-nesting":(valgol, valgol_nesting(100, max(1, scale // 10))),
+        "alternatives":  (alternatives_spec(300), alternatives_input(300, scale * 10)),
+    }
+
+
+#----- MEASUREMENT -------------------------------------------------------------
+
+def load(meta_text, native):
+    """A linked Program, from the text of a .meta file"""
+    prog = meta.Program()
+    prog.load_instrs(io.StringIO(meta_text))
+    prog.link()
+    if native:
+        meta.compile_native(prog)
+    return prog
+
+def compile_once(prog, text, outfile):
+    meta.MetaMachine().run(prog, io.StringIO(text), outfile)
+
+def best_time(prog, text, repeat):
+    """The fastest of repeat compilations, in seconds"""
+    best = None
+    with open(os.devnull, "w") as null:
+        for i in range(repeat):
+            start = time.perf_counter()
+            compile_once(prog, text, null)
+            t = time.perf_counter() - start
+            if best is None or t < best:
+                best = t
+    return best
+
+def peak_memory(prog, text):
+    """Peak bytes allocated by Python during one compilation"""
+    with open(os.devnull, "w") as null:
+        tracemalloc.start()
+        try:
+            compile_once(prog, text, null)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+def trace_fetches(prog, text, fetched):
+    """Call fetched(ip) for every VM instruction run by one compilation"""
+    # Every instruction passes once through the fetch line of loop(), so
+    # that line is traced, in loop() only.
+    loop = meta.MetaMachine.loop
+    lines, first = inspect.getsourcelines(loop)
+    fetch = first + [l.strip() for l in lines].index("op = ops[ip]")
+
+    def trace_line(frame, event, arg):
+        if event == "line" and frame.f_lineno == fetch:
+            fetched(frame.f_locals["ip"])
+        return trace_line
+
+    def trace_call(frame, event, arg):
+        if frame.f_code is loop.__code__:
+            return trace_line
+        return None
+
+    with open(os.devnull, "w") as null:
+        sys.settrace(trace_call)
+        try:
+            compile_once(prog, text, null)
+        finally:
+            sys.settrace(None)
+
+def count_instructions(prog, text):
+    """The number of VM instructions executed by one compilation"""
+    count = 0
+
+    def fetched(ip):
+        nonlocal count
+        count += 1
+
+    trace_fetches(prog, text, fetched)
+    return count
+
+def count_pairs(meta_text, text, counts):
+    """Add up the pairs of instructions run one straight after the other"""
+    # on the program as written, without dispatch tables or superinstructions
+    prog = load(meta_text, False)
+    prog.ops[:], prog.args[:] = prog.plain_code()
+    names = dict((op, name) for name, op in meta.OPCODES.items())
+    last = None
+
+    def fetched(ip):
+        nonlocal last
+        if last is not None and ip == last + 1:
+            counts[names[prog.ops[last]] + " " + names[prog.ops[ip]]] += 1
+        last = ip
+
+    trace_fetches(prog, text, fetched)
+
+def bench_case(name, spec, text, engines, repeat):
+    """Run one case through each engine that can run it"""
+    print("%s..." % name, file=sys.stderr)
+    if spec is None:
+        meta_text = meta.MetaMachine().compile(None, read_source("meta.spec"))
+    else:
+        meta_text = meta.MetaMachine().compile(None, spec)
+
+    result = {"chars": len(text), "instructions": None, "engines": {}}
+    for engine in engines:
+        if engine == "py":
+            if spec is not None:
+                continue  # the built-in compiler only knows meta.spec
+            prog = None
+        else:
+            prog = load(meta_text, engine == "native")
+            if result["instructions"] is None:
+                result["instructions"] = count_instructions(load(meta_text, False), text)
+
+        try:
+            seconds = best_time(prog, text, repeat)
+        except (meta.MetaError, RecursionError) as e:
+            result["engines"][engine] = {"error": str(e).split("\n")[0]}
+            continue
+        instrs = None
+        if prog is not None:
+            instrs = result["instructions"] / seconds
+        result["engines"][engine] = {
+            "seconds": seconds,
+            "chars_per_sec": len(text) / seconds,
+            "instrs_per_sec": instrs,
+            "peak_bytes": peak_memory(prog, text),
+        }
+    return result
+
+def startup_time(args, input_text, env, repeat):
+    """Fastest wall clock time of running meta.py on a tiny input"""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, META_PY] + args, input=input_text,
+                       env=env, stdout=subprocess.DEVNULL, text=True, check=True)
+        t = time.perf_counter() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+def bench_startup(repeat):
+    """Time to start up, load a program and compile a one line program"""
+    print("startup...", file=sys.stderr)
+    with tempfile.TemporaryDirectory() as tmp:
+        prog_name = os.path.join(tmp, "valgol1.meta")
+        with open(prog_name, "w") as f:
+            f.write(meta.MetaMachine().compile(None, read_source("valgol1.spec")))
+        env = dict(os.environ, META_CACHE_DIR=os.path.join(tmp, "cache"))
+        tiny = ".BEGIN .VAR X; 0 = X .END\n"
+        spec = ".SYNTAX S S = 'a' ; .END\n"
+
+        startup_time([prog_name], tiny, env, 1)  # fills the cache
+        return {
+            "py":        startup_time([], spec, env, repeat),
+            "vm":        startup_time(["--no-cache", prog_name], tiny, env, repeat),
+            "vm-cached": startup_time([prog_name], tiny, env, repeat),
+        }
+
+def run_benchmarks(scale, repeat, engines, only=None):
+    results = {
+        "meta_bench": 1,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "scale": scale,
+        "repeat": repeat,
+        "startup": bench_startup(repeat),
+        "cases": {},
+    }
+    for name, (spec, text) in make_cases(scale).items():
+        if only is None or name in only:
+            results["cases"][name] = bench_case(name, spec, text, engines, repeat)
+    return results
+
+
+def measure_pairs(scale):
+    """Percentage of the time each pair of instructions runs one after the
+    other, on the cases that use the shipped grammars, each case counting
+    the same"""
+    valgol = read_source("valgol1.spec")
+    total = collections.Counter()
+    cases = 0
+    for name, (spec, text) in make_cases(scale).items():
+        if spec is None:
+            spec = read_source("meta.spec")
+        elif spec != valgol:
+            continue
+        print("%s..." % name, file=sys.stderr)
+        counts = collections.Counter()
+        count_pairs(meta.MetaMachine().compile(None, spec), text, counts)
+        runs = sum(counts.values())
+        for pair, n in counts.items():
+            total[pair] += n * 100.0 / runs
+        cases += 1
+    for pair in total:
+        total[pair] /= cases
+    return total
+
+
+#----- REPORTS -----------------------------------------------------------------
+
+def write_results(results, file):
+    file.write("%-16s %-9s %9s %12s %12s %12s\n" % ("case", "engine",
+               "seconds", "chars/s", "instrs/s", "peak bytes"))
+    for name, case in results["cases"].items():
+        for engine, r in case["engines"].items():
+            if "error" in r:
+                file.write("%-16s %-9s %s\n" % (name, engine, r["error"]))
+                continue
+            instrs = "-"
+            if r["instrs_per_sec"] is not None:
+                instrs = "%.0f" % r["instrs_per_sec"]
+            file.write("%-16s %-9s %9.3f %12.0f %12s %12d\n" % (name, engine,
+                       r["seconds"], r["chars_per_sec"], instrs, r["peak_bytes"]))
+    for what, t in results["startup"].items():
+        file.write("%-16s %-9s %9.3f\n" % ("startup", what, t))
+
+def write_pairs(pairs, file, top=30):
+    for pair, percent in pairs.most_common(top):
+        file.write("%-10s %6.2f%%\n" % (pair, percent))
+
+def compare(base, new, threshold, file) -> bool:
+    """Report each change beyond threshold percent, False if any got worse"""
+    # Throughput is worse when it falls, memory and startup when they rise.
+    changes = []
+    for name, case in new["cases"].items():
+        for engine, r in case["engines"].items():
+            old = base["cases"].get(name, {}).get("engines", {}).get(engine)
+            if old is None or "error" in old or "error" in r:
+                continue
+            changes.append((name, engine, "chars/s", old["chars_per_sec"],
+                            r["chars_per_sec"], False))
+            changes.append((name, engine, "peak bytes", old["peak_bytes"],
+                            r["peak_bytes"], True))
+    for what, t in new["startup"].items():
+        if what in base["startup"]:
+            changes.append(("startup", what, "seconds", base["startup"][what],
+                            t, True))
+
+    ok = True
+    for name, engine, metric, old, now, higher_is_worse in changes:
+        change = (now - old) * 100.0 / old
+        worse = change > threshold if higher_is_worse else change < -threshold
+        better = change < -threshold if higher_is_worse else change > threshold
+        flag = ""
+        if worse:
+            flag = "REGRESSION"
+            ok = False
+        elif better:
+            flag = "improved"
+        file.write("%-16s %-10s %-10s %14.6g %14.6g %+7.1f%% %s\n" % (name,
+                   engine, metric, old, now, change, flag))
+    return ok
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="bench.py",
+        description="Benchmark the META-II engines of meta.py")
+    parser.add_argument("results", nargs="?",
+        help="with --compare, saved results to compare instead of running")
+    parser.add_argument("-o", "--output",
+        help="save the results to this JSON file")
+    parser.add_argument("--compare", metavar="BASELINE",
+        help="compare with the results saved in BASELINE")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+        help="percent change counted as a regression (default: %g)" % THRESHOLD)
+    parser.add_argument("--scale", type=int, default=1000,
+        help="size of the generated inputs, in statements (default: 1000)")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="runs of each measurement, the best is kept (default: 3)")
+    parser.add_argument("--engines", default=",".join(ENGINES),
+        help="engines to run, from %s" % ",".join(ENGINES))
+    parser.add_argument("--case", action="append",
+        help="run only this case (may be given more than once)")
+    parser.add_argument("--pairs", action="store_true",
+        help="just count the pairs of VM instructions that run one after "
+             "the other (what meta.py's superinstructions are made from)")
+    opts = parser.parse_args(argv)
+
+    if opts.pairs:
+        write_pairs(measure_pairs(opts.scale), sys.stdout)
+        return
+
+    if opts.results is not None:
+        if opts.compare is None:
+            parser.error("a results file is only used with --compare")
+        with open(opts.results) as f:
+            results = json.load(f)
+    else:
+        engines = opts.engines.split(",")
+        for engine in engines:
+            if engine not in ENGINES:
+                parser.error("no such engine: %s" % engine)
+        results = run_benchmarks(opts.scale, opts.repeat, engines, opts.case)
+        write_results(results, sys.stdout)
+        if opts.output is not None:
+            with open(opts.output, "w") as f:
+                json.dump(results, f, indent=2)
+                f.write("\n")
+
+    if opts.compare is not None:
+        with open(opts.compare) as f:
+            base = json.load(f)
+        print()
+        if not compare(base, results, opts.threshold, sys.stdout):
+            exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+# END
@@ -0,0 +1,105 @@
+#! /usr/bin/env python3
+#  metac.py
+#
+# A thin client for meta.py --serve. It takes the place of meta.py for a
+# single compilation: it sends its input to the server, and writes out the
+# output (and any error) that comes back, just as meta.py would have.
+#
+#   ./meta.py --serve &
+#   ./metac.py valgol1.meta < test1.valgol1 > test1.c
+#   make META=./metac.py
+#
+# It understands the options of a single compilation (--native, --packrat,
+# --line-comment and --block-comment). Given any others, or when no server
+# is running, it runs meta.py itself instead. The server is looked for at
+# $META_SERVER, else where meta.py --serve listens by default.
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def cache_dir():
+    """$META_CACHE_DIR, else meta-compiler in the user's cache directory"""
+    # as in metaii.py, which is not imported so as to start up quickly
+    cachedir = os.environ.get("META_CACHE_DIR")
+    if cachedir is None:
+        base = os.environ.get("XDG_CACHE_HOME")
+        if not base:
+            base = os.path.join(os.path.expanduser("~"), ".cache")
+        cachedir = os.path.join(base, "meta-compiler")
+    return cachedir
+
+def serve_address() -> str:
+    """$META_SERVER, else a Unix socket in the cache directory"""
+    address = os.environ.get("META_SERVER")
+    if not address:
+        address = os.path.join(cache_dir(), "server.sock")
+    return address
+
+def connect(address) -> socket.socket:
+    """Connect to the server at a Unix socket path or HOST:PORT"""
+    host, sep, port = address.rpartition(":")
+    if sep == "" or not port.isdigit() or "/" in address:
+        s = socket.socket(socket.AF_UNIX)
+        try:
+            s.connect(address)
+        except OSError:
+            s.close()
+            raise
+        return s
+    return socket.create_connection((host or "localhost", int(port)))
+
+def run_meta(argv):
+    """Run meta.py itself, in place of this process"""
+    meta = os.path.join(HERE, "meta.py")
+    os.execv(sys.executable, [sys.executable, meta] + argv)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="metac.py", add_help=False)
+    parser.add_argument("prog", nargs="?")
+    parser.add_argument("--native", action="store_true")
+    parser.add_argument("--packrat", action="store_true")
+    parser.add_argument("--line-comment")
+    parser.add_argument("--block-comment", nargs=2)
+    opts, others = parser.parse_known_args(argv)
+    if len(others) != 0:
+        run_meta(argv)
+
+    try:
+        server = connect(serve_address())
+    except OSError:
+        run_meta(argv)
+
+    request = {
+        "source": sys.stdin.read(),
+        "native": opts.native,
+        "packrat": opts.packrat,
+        "line_comment": opts.line_comment,
+        "block_comment": opts.block_comment,
+    }
+    if opts.prog is not None:
+        request["prog"] = os.path.abspath(opts.prog)
+
+    with server:
+        server.sendall(json.dumps(request).encode() + b"\n")
+        line = server.makefile("rb").readline()
+    if len(line) == 0:
+        sys.stderr.write("metac.py: no response from the server\n")
+        exit(1)
+
+    response = json.loads(line)
+    sys.stdout.write(response.get("output", ""))
+    if not response["ok"]:
+        # reported the way meta.py reports a failed compilation
+        print()
+        sys.stderr.write(response["error"])
+        exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+# END
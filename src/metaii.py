@@ -0,0 +1,4049 @@
+#  metaii.py  21/09/2019  D.J.Whale
+#
+# An interpreter for the META-II virtual machine
+#
+# This is the engine behind meta.py, kept in a module of its own so that
+# Python compiles it once and caches it, rather than on every run. Modules
+# that only some runs need (for --batch, --serve, --split, --mmap and the
+# program cache) are imported where they are used, not here.
+
+import codecs
+import collections
+import io
+import marshal
+import os
+import re
+import sys
+import time
+
+
+#----- CONFIG ------------------------------------------------------------------
+
+ERR_SYNTAX_ERROR = "Syntax error"
+QUOTE            = "'\""
+WHITESPACE       = " \t\r\n"
+
+# Longest piece of input read at a time. Lines longer than this are read
+# in several pieces, so that one huge line does not have to be held at once.
+READ_CHUNK       = 65536
+
+def debug(*args):
+    s = ""
+    for a in args:
+        s += str(a)
+    sys.stderr.write(s)
+    sys.stderr.write("\n")
+
+
+#------ ERROR HANDLING ---------------------------------------------------------
+
+class MetaError(Exception):
+    """A fatal error, carrying the full failure report as its message"""
+    pass
+
+def fail(context="", ip=0, ip_to_lineno=None, m2stack=(), listing=""):
+    """Raise a fatal error and stop"""
+    # The report carries everything, even a listing of the program, so that
+    # whoever catches the error decides where all of it goes.
+    # if no linenos, don't try to print them
+    try:
+        lineref = ",lineno=%d" % ip_to_lineno[ip]
+    except:
+        lineref = ""
+    report = listing + "failed(ip=%d%s):%s\n" % (ip, lineref, context)
+
+    import traceback
+    report += format_py_stack(traceback.extract_stack())
+    report += "m2stack:\n"
+    for line in m2stack:
+        report += line + "\n"
+    raise MetaError(report)
+
+def format_py_stack(s):
+    r = "pystack:"
+    for si in s[1:-1]:
+        r += "%s(%s) " % (si.name, str(si.lineno))
+
+    return r + "\n"
+
+
+#----- VM PROGRAM LOADER -------------------------------------------------------
+
+def parse_line(line):
+    """Parse a line of <label> | <spc>+ instr <spc>+ [addr]"""
+    # All parts are space separated
+    # But if see a single quote, must read until next single quote.
+    # returns None if nothing (blank line, comment etc).
+    # Returns a string if it is a valid label line.
+    # Returns a tuple of (instr, addr) if it is an instruction line.
+
+    # Empty lines produce nothing
+    if len(line) == 0: return None
+
+    # A line starting with a non space, is always a label,
+    if line[0] != ' ':
+        # LABEL
+        # ... but it must not have any spaces on the line.
+        if ' ' in line:
+            fail("parse_line:spaces are not allowed on label lines")
+            return None
+        line = line.strip()  # strip nl
+        return line  # a string is a label instr
+
+    # It must be an instruction line.
+    line = line.strip()  # strip leading ws and trailing ws/nl
+
+    # Everything up to first ws is instruction,
+    # optional rest is address. Address might have spaces in it if quoted.
+    if not ' ' in line:
+        # instr
+        return (line, )
+    else:
+        # instr addr
+        ws = line.index(" ")
+        instr = line[:ws]
+        addr = line[ws+1:].strip()
+        return (instr, addr)
+
+class Program():
+    """A META-II VM program, loaded once and then run over any number of inputs"""
+    def __init__(self):
+        # The full program to execute. A list of instructions
+        self.instrs = []  # list of tuple (operand, optional-address)
+
+        self.label_to_ip = {}  # map label->ip, for efficient jumps
+
+        self.ip_to_lineno = {}  # map ip->lineno, for error message use
+
+        # The decoded program, in parallel with instrs[], filled in by link()
+        self.ops  = []  # opcode (int) of each instr
+        self.args = []  # pre-decoded operand of each instr, or None
+
+        # bind() function of the program translated to Python, if it has been
+        # compiled with compile_native(), else None to run it on loop()
+        self.native = None
+        self.native_code = None  # the code object that defines bind()
+
+        # Comments in the input, skipped along with whitespace: a line comment
+        # prefix and a (start, end) pair for block comments, or None for none
+        self.line_comment = None
+        self.block_comment = None
+
+    def __getstate__(self):
+        # The native form is pickled as its marshalled code object,
+        # and bound again when it is unpickled.
+        state = self.__dict__.copy()
+        state["native"] = None
+        if self.native_code is not None:
+            state["native_code"] = marshal.dumps(self.native_code)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.native_code is not None:
+            bind_native(self, marshal.loads(self.native_code))
+
+    def add_instr(self, token, lineno):
+        ip = len(self.instrs)  # ip of next instr
+        if isinstance(token, str):
+            # LABEL
+            token = token.strip()
+            if len(token) != 0:
+                self.label_to_ip[token] = ip
+        else:
+            # INSTR
+            self.instrs.append(token)
+            self.ip_to_lineno[ip] = lineno
+
+    def load_instrs(self, file):
+        self.load_lines(file.readlines())
+
+    def load_lines(self, lines):
+        """Load the program from its lines of text, with or without newlines"""
+        lineno = 1
+        for l in lines:
+            #debug("parse_line:", l)
+            instr = parse_line(l)
+            ##debug("  gives instr:%s" % str(instr))
+            if instr is not None:
+                self.add_instr(instr, lineno)
+            lineno += 1
+
+    def format_instrs(self) -> str:
+        """A listing of the instructions and of where each label is"""
+        lines = []
+        ip = 0
+        for i in self.instrs:
+            lines.append("%d:%s\n" % (ip, i))
+            ip += 1
+
+        for l in self.label_to_ip:
+            ip = self.label_to_ip[l]
+            lines.append("%s->%d:%s\n" % (l, ip, self.instrs[ip]))
+        return "".join(lines)
+
+    def write_instrs(self, file):
+        """Write the program out in the form load_instrs() reads"""
+        labels = {}
+        for label, ip in self.label_to_ip.items():
+            labels.setdefault(ip, []).append(label)
+        for ip in range(len(self.instrs) + 1):
+            for label in labels.get(ip, []):
+                file.write(label + "\n")
+            if ip < len(self.instrs):
+                file.write(INSTR_INDENT + " ".join(self.instrs[ip]) + "\n")
+
+    #----- VM PROGRAM LINKER ---------------------------------------------------
+
+    def link(self):
+        """Decode instrs[] into ops[] and args[], resolving all labels"""
+        del self.ops[:]
+        del self.args[:]
+
+        for ip in range(len(self.instrs)):
+            instr = self.instrs[ip]
+            name = instr[0]
+            try:
+                op = OPCODES[name]
+            except KeyError:
+                fail("link:Unknown instr:%s" % name, ip, self.ip_to_lineno)
+
+            arg = None
+            if op in JUMP_OPS or op == OP_TST or op == OP_CL:
+                if len(instr) < 2:
+                    fail("link:missing operand:%s" % name, ip, self.ip_to_lineno)
+                arg = instr[1]
+
+            if op in JUMP_OPS:
+                try:
+                    arg = self.label_to_ip[arg]
+                except KeyError:
+                    fail("link:missing label:%s" % arg, ip, self.ip_to_lineno)
+            elif op == OP_TST:
+                arg = arg[1:-1]  # strip quotes
+            elif op == OP_CL:
+                arg = arg[1:-1] + " "  # strip quotes, add trailing blank
+
+            self.ops.append(op)
+            self.args.append(arg)
+
+        add_dispatch(self)
+        fuse(self)
+
+    def plain_code(self):
+        """Copies of ops[] and args[] with each DSP put back as its test,
+        and each superinstruction as its first instruction"""
+        ops = list(self.ops)
+        args = list(self.args)
+        for ip in range(len(ops)):
+            if ops[ip] == OP_DSP:
+                ops[ip] = args[ip][2]
+                args[ip] = args[ip][3]
+            elif ops[ip] in FUSED:
+                ops[ip] = FUSED[ops[ip]][0]
+                args[ip] = args[ip][0]
+        return ops, args
+
+def load_program(filename) -> Program:
+    """Load and link a META-II VM program from a file"""
+    prog = Program()
+    with open(filename) as file:
+        prog.load_instrs(file)
+    prog.link()
+    return prog
+
+
+# Opcodes of the linked program.
+# Numbered in the order the instructions are tested by loop().
+# OP_DSP, and those of two instructions (see fuse()), are not in .meta files.
+OP_BT       = 0
+OP_BF       = 1
+OP_R        = 2
+OP_CLL      = 3
+OP_DSP      = 4
+OP_TST_BF   = 5
+OP_CL_OUT   = 6
+OP_SET_BE   = 7
+OP_BE       = 8
+OP_GN1_OUT  = 9
+OP_TST_BE   = 10
+OP_OUT_R    = 11
+OP_BE_R     = 12
+OP_CL       = 13
+OP_CL_CI    = 14
+OP_LB       = 15
+OP_OUT      = 16
+OP_SET      = 17
+OP_SR_BF    = 18
+OP_GN1      = 19
+OP_GN2      = 20
+OP_ID_BF    = 21
+OP_NUM      = 22
+OP_CI       = 23
+OP_SR       = 24
+OP_ID       = 25
+OP_TST      = 26
+OP_B        = 27
+OP_END      = 28
+
+OPCODES = {
+    "TST": OP_TST, "ID":  OP_ID,  "NUM": OP_NUM, "SR":  OP_SR,
+    "CLL": OP_CLL, "R":   OP_R,   "SET": OP_SET, "B":   OP_B,
+    "BT":  OP_BT,  "BF":  OP_BF,  "BE":  OP_BE,  "CL":  OP_CL,
+    "CI":  OP_CI,  "GN1": OP_GN1, "GN2": OP_GN2, "LB":  OP_LB,
+    "OUT": OP_OUT, "END": OP_END,
+}
+
+# Instructions whose operand is a label, resolved to an ip at link time
+JUMP_OPS = (OP_CLL, OP_B, OP_BT, OP_BF)
+
+
+#----- FIRST SETS AND DISPATCH -------------------------------------------------
+
+# Alternatives compile to a chain of tests, each followed by a BF to the next
+# alternative, and the last BF goes on past them all with the switch off:
+#
+#       TST 'EDIT'      <- head of the chain
+#       BF A31
+#       ...
+#   A31 BT A32          <- where the first alternative's body ends
+#       TST 'PRINT'
+#       BF A33
+#       ...
+#   A32
+#   A33 R
+#
+# The FIRST set of a test is the set of characters its token can start with,
+# so on any other next non-blank character the test is sure to fail, having
+# done nothing more than skip the blanks. For a CLL it is the FIRST set of the
+# rule, as long as the rule then fails cleanly too, by way of its own chain
+# of tests, out to an R. add_dispatch() puts a DSP in place of the head of
+# each chain, which skips the blanks and jumps straight to the first
+# alternative that could match the next character, or past them all.
+#
+# FIRST sets only hold ASCII characters exactly (str.isalpha() knows many
+# more letters), so a DSP leaves any other character to the tests.
+
+TEST_OPS  = (OP_TST, OP_ID, OP_NUM, OP_SR, OP_CLL)
+ID_FIRST  = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_")
+NUM_FIRST = frozenset("0123456789")
+SR_FIRST  = frozenset(QUOTE)
+
+class FirstSets():
+    """FIRST sets of the tests and rules of a linked program.
+
+    A FIRST set of None means that it is not known, or that the test or rule
+    might succeed, or do something else, without a token to start it.
+    """
+    def __init__(self, ops, args):
+        self.ops = ops
+        self.args = args
+        self.rules = {}  # rule ip -> FIRST set
+
+    def test(self, ip):
+        """FIRST set of the test at ip"""
+        op = self.ops[ip]
+        arg = self.args[ip]
+        if op == OP_TST:
+            if len(arg) == 0:
+                return None  # always matches
+            return frozenset(arg[0])
+        elif op == OP_ID:
+            return ID_FIRST
+        elif op == OP_NUM:
+            return NUM_FIRST
+        elif op == OP_SR:
+            return SR_FIRST
+        elif op == OP_CLL:
+            return self.rule(arg)
+        return None
+
+    def rule(self, ip):
+        """FIRST set of the rule at ip"""
+        if ip in self.rules:
+            return self.rules[ip]  # None while still working it out
+        self.rules[ip] = None
+        first = None
+        if self.ops[ip] in TEST_OPS:
+            first = self.failing(ip)
+        self.rules[ip] = first
+        return first
+
+    def failing(self, ip):
+        """FIRST set of the code at ip, run with the switch off"""
+        # i.e. the union of the chain of tests found there, if it ends in R
+        ops, args = self.ops, self.args
+        first = frozenset()
+        seen = set()
+        while ip not in seen:
+            seen.add(ip)
+            op = ops[ip]
+            if op in TEST_OPS:
+                f = self.test(ip)
+                if f is None or ops[ip+1] != OP_BF:
+                    return None
+                first = first | f
+                ip = args[ip+1]
+            elif op == OP_R:
+                return first
+            elif op == OP_BF or op == OP_B or op == OP_BT:
+                ip = switch_off(ops, args, ip)
+            else:
+                return None  # anything else does something
+        return None
+
+def switch_off(ops, args, ip):
+    """Where running from ip with the switch off gets to a test or stops"""
+    seen = set()
+    while ip not in seen:
+        seen.add(ip)
+        op = ops[ip]
+        if op == OP_BT:
+            ip += 1
+        elif op == OP_BF or op == OP_B:
+            ip = args[ip]
+        else:
+            break
+    return ip
+
+def add_dispatch(prog):
+    """Put a DSP at the head of every chain of alternatives worth it"""
+    ops, args = prog.ops, prog.args
+    firsts = FirstSets(ops, args)
+
+    chained = set()  # tests that are not the first of their chain
+    for ip in range(len(ops) - 1):
+        if ops[ip] in TEST_OPS and ops[ip+1] == OP_BF:
+            chained.add(switch_off(ops, args, args[ip+1]))
+
+    # worked out for every chain before any DSP goes in
+    dispatches = []
+    for head in range(len(ops) - 1):
+        if ops[head] not in TEST_OPS or ops[head+1] != OP_BF or head in chained:
+            continue
+
+        # next non-blank character -> first alternative that could match it
+        table = {}
+        alternatives = 0
+        ip = head
+        seen = set()
+        while ip not in seen and ops[ip] in TEST_OPS and ops[ip+1] == OP_BF:
+            seen.add(ip)
+            first = firsts.test(ip)
+            if first is None:
+                break  # this one has to be tried, whatever comes next
+            for ch in first:
+                table.setdefault(ch, ip)
+            alternatives += 1
+            ip = switch_off(ops, args, args[ip+1])
+        default = ip  # where a character not in the table goes
+
+        if alternatives >= 2:
+            dispatches.append((head, table, default))
+
+    for head, table, default in dispatches:
+        args[head] = (table, default, ops[head], args[head])
+        ops[head] = OP_DSP
+
+
+#----- SUPERINSTRUCTIONS -------------------------------------------------------
+
+# The pairs of instructions that most often run one after the other, each of
+# which loop() runs as a single instruction. They were picked by counting the
+# pairs executed (bench.py --pairs) by meta.meta and valgol1.meta, as every
+# pair run about 1.5% of the time or more, less those starting with a BT or BF
+# (half the time the second is jumped over), or a CLL (the second only runs
+# after the rule returns), and OUT CL and BE TST, which mostly overlap CL OUT
+# and TST BF.
+#
+# fuse() puts the fused opcode, with both operands, in place of the first of
+# a pair and leaves the second where it was, so that every ip stays the same.
+# loop() goes on from after the second. A pair is only fused if nothing jumps
+# to its second.
+
+FUSED = {
+    OP_TST_BF:  (OP_TST, OP_BF),
+    OP_CL_OUT:  (OP_CL,  OP_OUT),
+    OP_SET_BE:  (OP_SET, OP_BE),
+    OP_BE_R:    (OP_BE,  OP_R),
+    OP_OUT_R:   (OP_OUT, OP_R),
+    OP_TST_BE:  (OP_TST, OP_BE),
+    OP_CL_CI:   (OP_CL,  OP_CI),
+    OP_GN1_OUT: (OP_GN1, OP_OUT),
+    OP_ID_BF:   (OP_ID,  OP_BF),
+    OP_SR_BF:   (OP_SR,  OP_BF),
+}
+FUSE = dict((pair, op) for op, pair in FUSED.items())
+
+def fuse(prog):
+    """Put a superinstruction in place of every pair that can have one"""
+    ops, args = prog.ops, prog.args
+    targets = set([0])
+    for ip in range(len(ops)):
+        if ops[ip] in JUMP_OPS:
+            targets.add(args[ip])
+        elif ops[ip] == OP_DSP:
+            targets.update(args[ip][0].values())
+            targets.add(args[ip][1])
+
+    ip = 0
+    while ip < len(ops) - 1:
+        op = FUSE.get((ops[ip], ops[ip+1]))
+        if op is None or ip+1 in targets:
+            ip += 1
+        else:
+            args[ip] = (args[ip], args[ip+1])
+            ops[ip] = op
+            ip += 2
+
+
+#----- PEEPHOLE OPTIMIZER ------------------------------------------------------
+
+# optimize() rewrites a loaded, not yet linked, program. It works out which
+# value the switch must have on the way into each instruction, and with that:
+#
+#   threads jumps:      a branch to a B (or to a BT/BF/BE whose outcome is
+#                       known there) goes straight on to where that leads
+#   folds the switch:   a BT/BF/BE/SET whose outcome is known is turned
+#                       into a B, or removed
+#   removes dead code:  instructions that nothing can reach, branches to
+#                       the next instruction, and SETs nothing reads
+#
+# and keeps on doing so until none of them finds any more to do. A B to an
+# R or an END just becomes a copy of it.
+#
+# Every rewrite in a pass relies on the switch values worked out at its
+# start, which removing a SET that nothing reads would change. So unused
+# SETs are only removed in a pass of their own, once nothing else changes.
+
+BRANCHES     = ("B", "BT", "BF")
+LABEL_INSTRS = ("B", "BT", "BF", "CLL")  # operand is a label
+SETS_SWITCH  = ("TST", "ID", "NUM", "SR", "SET")
+OUTPUT_INSTRS = ("CL", "CI", "OUT", "GN1", "GN2", "LB")  # switch untouched
+
+def optimize(prog) -> collections.Counter:
+    """Optimize the instructions of prog in place, returning what was done"""
+    opt = Optimizer(prog)
+    while opt.improve():
+        pass
+    opt.store(prog)
+    return opt.counts
+
+class Optimizer():
+    def __init__(self, prog):
+        # [name, operand] for each instruction, a label operand as its ip
+        self.code = []
+        for ip in range(len(prog.instrs)):
+            instr = prog.instrs[ip]
+            arg = None
+            if len(instr) > 1:
+                arg = instr[1]
+            if instr[0] in LABEL_INSTRS:
+                try:
+                    arg = prog.label_to_ip[arg]
+                except KeyError:
+                    fail("optimize:missing label:%s" % arg, ip, prog.ip_to_lineno)
+            self.code.append([instr[0], arg])
+        self.labels = dict(prog.label_to_ip)
+        self.linenos = dict(prog.ip_to_lineno)
+        self.counts = collections.Counter()  # what has been done, and how often
+
+    def switches(self) -> dict:
+        """ip -> switch on the way in (None if either), for every ip reached"""
+        code = self.code
+        state = {0: None}
+        work = [0]
+        while len(work) != 0:
+            ip = work.pop()
+            if ip >= len(code):
+                continue  # off the end
+            name, arg = code[ip]
+            s = state[ip]
+            if name in SETS_SWITCH:
+                next = [(ip+1, True if name == "SET" else None)]
+            elif name == "CLL":
+                next = [(arg, None), (ip+1, None)]
+            elif name == "B":
+                next = [(arg, s)]
+            elif name == "BT" or name == "BF":
+                taken = name == "BT"
+                next = []
+                if s is not (not taken):
+                    next.append((arg, taken))
+                if s is not taken:
+                    next.append((ip+1, not taken))
+            elif name == "BE":
+                next = [(ip+1, True)]
+            elif name == "R" or name == "END":
+                next = []
+            else:
+                next = [(ip+1, s)]
+
+            for ip, s in next:
+                if ip not in state:
+                    state[ip] = s
+                elif state[ip] is not None and state[ip] != s:
+                    state[ip] = None
+                else:
+                    continue
+                work.append(ip)
+        return state
+
+    def thread(self, ip, switch):
+        """Where a jump to ip, with this switch, really ends up"""
+        # It stops at an instruction removed earlier in the pass, which
+        # compact() will put what comes after it in place of.
+        code = self.code
+        seen = set()
+        while ip < len(code) and ip not in seen and code[ip] is not None:
+            seen.add(ip)
+            name, arg = code[ip]
+            if name == "B" or (name == "BT" and switch is True) \
+                    or (name == "BF" and switch is False):
+                ip = arg
+            elif (name == "BT" and switch is False) \
+                    or (name == "BF" and switch is True) \
+                    or (name in ("BE", "SET") and switch is True):
+                ip += 1
+            else:
+                break
+        return ip
+
+    def switch_unused(self, ip) -> bool:
+        """True if the switch is always set again from ip before it is read"""
+        code = self.code
+        seen = set()
+        while ip < len(code) and ip not in seen:
+            seen.add(ip)
+            if code[ip] is None:
+                return False
+            name, arg = code[ip]
+            if name in SETS_SWITCH:
+                return True
+            elif name == "B":
+                ip = arg
+            elif name in OUTPUT_INSTRS:
+                ip += 1
+            else:
+                return False  # a CLL might read it, in the rule it calls
+        return False
+
+    def improve(self) -> bool:
+        """One pass of optimizations, True if anything changed"""
+        changed = self.rewrite()
+        if not changed:
+            changed = self.remove_unused_sets()
+        if changed:
+            self.compact()
+        return changed
+
+    def rewrite(self) -> bool:
+        """Thread, fold and remove what the switch values show can go"""
+        code = self.code
+        counts = self.counts
+        state = self.switches()
+        changed = False
+        for ip in range(len(code)):
+            name, arg = code[ip]
+            if ip not in state:
+                code[ip] = None
+                counts["unreachable removed"] += 1
+                changed = True
+                continue
+            s = state[ip]
+
+            if (name == "BT" or name == "BF") and s is not None:
+                counts["branches folded"] += 1
+                changed = True
+                if s is (name == "BT"):
+                    name = "B"
+                    code[ip] = [name, arg]
+                else:
+                    code[ip] = None
+                    continue
+            elif (name == "BE" or name == "SET") and s is True:
+                code[ip] = None
+                counts["branches folded"] += 1
+                changed = True
+                continue
+
+            if name in BRANCHES:
+                target = self.thread(arg, s if name == "B" else name == "BT")
+                if target != arg:
+                    code[ip] = [name, target]
+                    counts["jumps threaded"] += 1
+                    changed = True
+                if target == ip + 1:
+                    code[ip] = None
+                    counts["jumps to next removed"] += 1
+                    changed = True
+                elif name == "B" and target < len(code) \
+                        and code[target] is not None \
+                        and code[target][0] in ("R", "END"):
+                    code[ip] = [code[target][0], None]
+                    counts["jumps to R/END copied"] += 1
+                    changed = True
+        return changed
+
+    def remove_unused_sets(self) -> bool:
+        """Remove the SETs whose switch is set again before it is read"""
+        code = self.code
+        changed = False
+        for ip in range(len(code)):
+            if code[ip][0] == "SET" and self.switch_unused(ip+1):
+                code[ip] = None
+                self.counts["unused SETs removed"] += 1
+                changed = True
+        return changed
+
+    def compact(self):
+        """Drop removed instructions, moving what was at them on to the next"""
+        new_ip = []
+        n = 0
+        for instr in self.code:
+            new_ip.append(n)
+            if instr is not None:
+                n += 1
+        new_ip.append(n)  # the end
+
+        code = []
+        linenos = {}
+        for ip in range(len(self.code)):
+            instr = self.code[ip]
+            if instr is not None:
+                if instr[0] in LABEL_INSTRS:
+                    instr[1] = new_ip[instr[1]]
+                if ip in self.linenos:
+                    linenos[len(code)] = self.linenos[ip]
+                code.append(instr)
+        self.code = code
+        self.linenos = linenos
+        for label in self.labels:
+            self.labels[label] = new_ip[self.labels[label]]
+
+    def store(self, prog):
+        """Put the optimized code back into prog, labelling only what is used"""
+        # A jump to an ip keeps the first of its labels, or gets a new one.
+        names = {}
+        for label, ip in self.labels.items():
+            names.setdefault(ip, label)
+        targets = sorted(set(arg for name, arg in self.code if name in LABEL_INSTRS))
+        n = 0
+        for ip in targets:
+            while ip not in names:
+                n += 1
+                label = "J%02d" % n
+                if label not in self.labels:
+                    names[ip] = label
+
+        prog.instrs = []
+        for name, arg in self.code:
+            if arg is None:
+                prog.instrs.append((name, ))
+            elif name in LABEL_INSTRS:
+                prog.instrs.append((name, names[arg]))
+            else:
+                prog.instrs.append((name, arg))
+        prog.label_to_ip = dict((names[ip], ip) for ip in targets)
+        prog.ip_to_lineno = self.linenos
+
+
+#----- INPUT READER ------------------------------------------------------------
+
+# ASCII only, see InputReader.skipws()
+ID_RE         = re.compile("[A-Za-z_][A-Za-z0-9_]*")
+NUMBER_RE     = re.compile(r"[0-9]+(\.[0-9]+)*\.?")
+
+def skip_pattern(line_comment=None, block_comment=None) -> str:
+    """Regex for a run of whitespace and comments"""
+    # An unfinished block comment runs to the end of the buffer, so that
+    # skipws() hands it over to skipws_chars() to read the rest.
+    if line_comment is None and block_comment is None:
+        return "[%s]*" % re.escape(WHITESPACE)
+    parts = ["[%s]+" % re.escape(WHITESPACE)]
+    if line_comment is not None:
+        parts.append(re.escape(line_comment) + "[^\n]*")
+    if block_comment is not None:
+        start, end = block_comment
+        parts.append("(?s:%s(?:.*?%s|.*))" % (re.escape(start), re.escape(end)))
+    return "(?:%s)*" % "|".join(parts)
+
+def comment_openers(line_comment=None, block_comment=None) -> list:
+    """What each kind of comment starts with"""
+    openers = []
+    if line_comment is not None:
+        openers.append(line_comment)
+    if block_comment is not None:
+        openers.append(block_comment[0])
+    return openers
+
+class InputReader():
+    """The input stream of one compilation, and the lexer that reads it"""
+    def __init__(self, file, fail=fail):
+        self.file = file
+        self.fail = fail
+        self.cache = ""      # buffered input text, or None at end of file
+        self.pos = 0         # cursor: cache[:pos] has been consumed by save()
+        self.lookahead = 0   # chars peeked past pos, not yet consumed
+        self.saved = ""
+        self.base = 0        # absolute input position of cache[0]
+        self.keep = None     # absolute position to keep the text from, if any
+        self.ended = None    # the last cache, after end of file
+        self.skips = None    # see remember_scans()
+        self.set_comments(None, None)
+
+    def set_comments(self, line_comment, block_comment):
+        """Skip these comments (see Program) with the whitespace from now on"""
+        self.line_comment = line_comment
+        self.block_comment = block_comment
+        # what skipws() looks for, and how much of it is needed to be sure
+        openers = comment_openers(line_comment, block_comment)
+        self.skip_first = WHITESPACE + "".join(s[0] for s in openers)
+        self.skip_re = re.compile(skip_pattern(line_comment, block_comment))
+        self.skip_margin = max([1] + [len(s) for s in openers]) - 1
+
+    def nextline(self):
+        """Read next line from input stream and append to cache"""
+        # The consumed prefix cache[:pos] is dropped here, so a refill only
+        # costs the unconsumed lookahead plus the new text, and memory stays
+        # bounded by READ_CHUNK even when the input is one very long line.
+        # Text from self.keep on is kept, so that seek() can go back to it.
+        if self.cache is None:
+            self.fail("nextline:end of file")
+
+        line = self.file.readline(READ_CHUNK)
+        if line != "":
+            drop = self.pos
+            if self.keep is not None:
+                drop = min(drop, self.keep - self.base)
+            self.cache = self.cache[drop:] + line
+            self.base += drop
+            self.pos -= drop
+            return line[0]
+        else:
+            self.ended = self.cache
+            self.cache = None
+
+    def peek(self):
+        """read currently pointed to char (including current lookahead)"""
+        cache = self.cache
+        if cache is None:
+            self.fail("peek:end of file")
+        i = self.pos + self.lookahead
+        if i >= len(cache):
+            ##debug("peek: nextline")
+            ch = self.nextline()
+        else:
+            ch = cache[i]
+            ##debug("peek: ch='%s' (%d)" % (ch, len(ch)))
+        return ch
+
+    def advance(self, n=1):
+        """Advance lookahead ptr by n"""
+        assert self.pos + self.lookahead <= len(self.cache)
+        self.lookahead += n
+
+    def discard(self):
+        """Discard any lookahead by resetting lookahead=0"""
+        self.lookahead = 0
+
+    def save(self, n=None):
+        """Delete n {default lookahead amount) chars from input stream"""
+        # Only the cursor moves, the buffer is not copied.
+        if self.cache is None:
+            return
+        if n is None: n = self.lookahead
+        assert n <= self.lookahead
+        pos = self.pos
+        self.saved = self.cache[pos:pos+n]
+        self.pos = pos + n
+        self.lookahead -= n
+
+    def recall(self):
+        """Read the last string saved with save()"""
+        return self.saved
+
+    def tell(self):
+        """The absolute input position of the cursor"""
+        return self.base + self.pos
+
+    def saved_at(self):
+        """The absolute input position that saved was taken from"""
+        return self.tell() - len(self.saved)
+
+    def seek(self, where, saved):
+        """Go back (or forward) to a position from tell(), and its saved"""
+        # The text must still be there, see self.keep.
+        if self.cache is None:
+            self.cache = self.ended
+        self.pos = where - self.base
+        self.lookahead = 0
+        self.saved = saved
+
+    def skip_to(self, where, saved):
+        """seek() forward, reading on through the input as far as it needs"""
+        while self.cache is not None and where > self.base + len(self.cache):
+            self.pos = len(self.cache)  # all consumed, so nextline() drops it
+            self.lookahead = 0
+            self.nextline()
+        self.seek(where, saved)
+
+    #----- FAST PATHS ----------------------------------------------------------
+
+    # The lexer first tries each token with a regular expression over the
+    # buffer. It only does that where the answer is certain to be the same as
+    # the original one character at a time code (the *_chars() methods):
+    # the regexes only know ASCII, where str.isalpha() and friends would
+    # accept other letters and digits, so any other character, or running
+    # into the end of the buffer (which needs a refill, or is the end of
+    # file), hands the token over to the *_chars() method instead.
+
+    def skipws(self):
+        """skip and consume ws (and comments) on input until we get to next non ws"""
+        # Near the end of the buffer, a comment might go on in the next one.
+        cache = self.cache
+        if cache is not None:
+            i = self.pos + self.lookahead
+            if i < len(cache):
+                ch = cache[i]
+                if ch not in self.skip_first:
+                    return ch
+                skips = self.skips
+                if skips is not None and self.base + i in skips:
+                    end = skips[self.base + i] - self.base
+                else:
+                    end = self.skip_re.match(cache, i).end()
+                if end + self.skip_margin < len(cache):
+                    if end == i:
+                        return ch  # not a comment after all
+                    if skips is not None:
+                        skips[self.base + i] = self.base + end
+                        if len(skips) > SCAN_CACHE_SIZE:
+                            forget_scans(skips)
+                    self.lookahead = end - self.pos
+                    self.save()
+                    return cache[end]
+        return self.skipws_chars()
+
+    def id(self):
+        """Try for an identifier"""
+        self.skipws()
+        cache = self.cache
+        if cache is not None:
+            i = self.pos + self.lookahead
+            if i < len(cache) and cache[i] < "\x80":
+                m = ID_RE.match(cache, i)
+                if m is None:
+                    self.discard()
+                    return False
+                end = m.end()
+                if end < len(cache) and cache[end] < "\x80":
+                    self.lookahead = end - self.pos
+                    self.save()
+                    return True
+        return self.id_chars()
+
+    def number(self):
+        """Try to read a number"""
+        self.skipws()
+        cache = self.cache
+        if cache is not None:
+            i = self.pos + self.lookahead
+            if i < len(cache) and cache[i] < "\x80":
+                m = NUMBER_RE.match(cache, i)
+                if m is None:
+                    self.discard()
+                    return False
+                end = m.end()
+                if end < len(cache) and cache[end] < "\x80":
+                    if cache[end] == ".":
+                        # only after a period, which the regex would
+                        # otherwise have taken: two periods together
+                        self.discard()
+                        return False
+                    self.lookahead = end - self.pos
+                    self.save()
+                    return True
+        return self.number_chars()
+
+    def dot_string(self):
+        """Try to read a quoted string"""
+        self.skipws()
+        cache = self.cache
+        if cache is not None:
+            i = self.pos + self.lookahead
+            if i < len(cache):
+                quote = cache[i]
+                if quote not in QUOTE:
+                    self.discard()
+                    return False
+                end = cache.find(quote, i+1)
+                if end != -1:
+                    self.lookahead = end + 1 - self.pos
+                    self.save()
+                    return True
+        return self.dot_string_chars()
+
+    def is_literal(self, s):
+        """Try to read a specific literal"""
+        # NOTE, will erroneously match shorter prefixes,
+        # so '&' and '&&' will match '&'.
+        self.skipws()
+        cache = self.cache
+        if cache is not None:
+            i = self.pos + self.lookahead
+            if cache.startswith(s, i):
+                self.lookahead = i + len(s) - self.pos
+                self.save()
+                return True
+            if i + len(s) <= len(cache):
+                self.discard()
+                return False
+        return self.is_literal_chars(s)
+
+    #----- ONE CHARACTER AT A TIME ---------------------------------------------
+
+    def skipws_chars(self):
+        """skip and consume ws (and comments) on input until we get to next non ws"""
+        # if current char, on entry, is not whitespace, do nothing
+        # so that we could interleave this and not damage ongoing save/recall
+        ch = self.peek()
+        if not ch in WHITESPACE and not self.skip_comment(ch): return ch
+
+        while True:
+            ch = self.peek()
+            if ch in WHITESPACE:
+                self.advance()
+            elif not self.skip_comment(ch):
+                self.save()
+                return ch
+
+    def skip_comment(self, ch) -> bool:
+        """Advance past the comment that starts at ch, if it is one"""
+        # An unfinished comment stops at the end of file, for the next peek()
+        # to fail on.
+        line = self.line_comment
+        if line is not None and ch == line[0] and self.looking_at(line):
+            while ch is not None and ch != "\n":
+                self.advance()
+                ch = self.peek()
+            return True
+
+        block = self.block_comment
+        if block is not None and ch == block[0][0] and self.looking_at(block[0]):
+            self.advance(len(block[0]))
+            while not self.looking_at(block[1]):
+                if self.peek() is None:
+                    return True
+                self.advance()
+            self.advance(len(block[1]))
+            return True
+        return False
+
+    def looking_at(self, s) -> bool:
+        """True if s comes next, after the lookahead (which is left as it was)"""
+        return self.prefix_length(s) == len(s)
+
+    def prefix_length(self, s) -> int:
+        """How much of the start of s comes next, after the lookahead"""
+        lookahead = self.lookahead
+        n = 0
+        for c in s:
+            if self.peek() != c:
+                break
+            self.advance()
+            n += 1
+        self.lookahead = lookahead
+        if self.cache is None:
+            self.cache = self.ended  # the next peek() finds the end again
+        return n
+
+    def number_length(self) -> int:
+        """How far number_chars() reads on from the lookahead, before it stops"""
+        lookahead = self.lookahead
+        n = 0
+        prev = None
+        ch = self.peek()
+        while ch is not None and (ch.isdigit() or
+                                  (ch == "." and prev not in (None, "."))):
+            self.advance()
+            n += 1
+            prev = ch
+            ch = self.peek()
+        self.lookahead = lookahead
+        if self.cache is None:
+            self.cache = self.ended
+        return n
+
+    #----- LEXER ---------------------------------------------------------------
+
+    def id_chars(self):
+        """Try for an identifier"""
+        ##debug("{TRY ID}")
+        # After deleting initial blanks in the input string,
+        self.skipws()
+
+        # test if it begins with an identifier,
+        # i.e. a letter followed by a sequence of letters and/or digits.
+        #NOTE, first must be letter
+        #NOTE: must be at least 1 char long
+        # If not,
+        # reset switch.
+        ch = self.peek()
+        if not (ch.isalpha() or ch == '_'):
+            self.discard()
+            return False
+
+        #NOTE, non first can be letter or digit
+        #NOTE: terminate on non letter/digit
+        while True:
+            self.advance()
+            ch = self.peek()
+            if not (ch.isalnum() or ch == "_"): break
+
+        # If so,
+        # delete the identifier and set switch.
+        ##debug("<<< match id '%s'" % str(self.cache))
+        self.save()
+        return True
+
+    def number_chars(self):
+        """Try to read a number"""
+        # After deleting initial blanks in the input string,
+        ##debug("{TRY NUMBER}")
+        self.skipws()
+
+        # test if it begins with a number,
+        # NOTE: must start with a digit
+        # If not,
+        # reset switch.
+        ch = self.peek()
+        if not ch.isdigit():
+            self.discard()
+            return False
+
+        self.advance()
+
+        # i.e. a string of digits which may contain embedded periods,
+        # but may not begin or end with a period.
+        # Moreover, no two periods may be next to one an other.
+        # NOTE: must end with a digit
+        # NOTE: non digit/period will terminate
+        # NOTE: if just seen a period, seeing a second period will be a no-match
+        prev_was_dot = False
+        while True:
+            ch = self.peek()
+            if ch == '.':
+                if prev_was_dot:
+                    self.discard()
+                    return False
+                prev_was_dot = True
+            else:
+                if not ch.isdigit():
+                    # If a number is found,
+                    # delete it and set switch.
+                    self.save()
+                    return True
+                prev_was_dot = False
+            self.advance()
+
+    def dot_string_chars(self):
+        """Try to read a quoted string"""
+        # After deleting initial blanks in the input string,
+        ##debug("{TRY QUOTED}")
+        self.skipws()
+
+        # test if it begins with a string,
+        # i.e. a single quote
+        ch = self.peek()
+        if ch not in QUOTE:
+            # If not,
+            # reset switch.
+            self.discard()
+            return False
+
+        self.advance()
+        quote = ch  # the open quote we found
+
+        # followed by a sequence of any characters other than a single quote.
+        # NOTE: any non quote char following will be part of string
+        # including WS
+        # NOTE: next quote will be end of string
+        while True:
+            ch = self.peek()
+            if ch == quote:  # close quote must match open quote
+                # If a string is found,
+                # delete it and set switch.
+                self.advance()
+                self.save()
+                return True
+            self.advance() # include this character
+
+    def is_literal_chars(self, s):
+        """Try to read a specific literal"""
+        ##debug("{TRY LITERAL '%s'}" % s)
+
+        # NOTE, will erroneously match shorter prefixes,
+        # so '&' and '&&' will match '&'.
+        # This is just a limitation of the meta-II approach.
+        self.skipws()
+
+        # compare it to the string given as argument.
+        la = 0
+        ls = len(s)
+        while la != ls:
+            ch = self.peek()
+            ##debug("literal %s   %s == %s" % (s, ch, s[la]))
+            if ch != s[la]: # no match
+                # If not met,
+                # reset switch
+                ##debug("  <<<literal '%s' did not match input:'%s'"% (str(s), str(self.cache)))
+                self.discard()
+                return False
+            la += 1
+            self.advance()
+
+        # If the comparison is met,
+        # delete the matched portion from the input
+        ##debug("  <<< literal matched '%s'" % str(self.cache))
+        self.save()
+        # and set switch.
+        return True
+
+
+#----- MAPPED INPUT ------------------------------------------------------------
+
+# A MappedReader scans a whole input file mapped into memory, as bytes, with
+# the same lexer as InputReader: positions are byte offsets, and nothing is
+# copied or decoded until save() takes a lexeme (for CI). Only UTF-8 input
+# is mapped, whose bytes below 0x80 are always the ASCII characters that the
+# fast paths look for. Any other character goes one character at a time,
+# decoded where it starts, as in InputReader.
+
+WHITESPACE_BYTES    = frozenset(WHITESPACE.encode())
+QUOTE_BYTES         = frozenset(QUOTE.encode())
+ID_BYTES_RE         = re.compile(ID_RE.pattern.encode())
+NUMBER_BYTES_RE     = re.compile(NUMBER_RE.pattern.encode())
+ASCII_CHARS         = [chr(b) for b in range(0x80)]
+
+def utf8_length(b):
+    """Length of the UTF-8 sequence that starts with the byte b"""
+    if b < 0xC0:
+        return 1  # ASCII (or a stray continuation byte)
+    elif b < 0xE0:
+        return 2
+    elif b < 0xF0:
+        return 3
+    return 4
+
+def map_input(file):
+    """A reader for file: mapped into memory if it can be, else buffered"""
+    # A pipe or a terminal (stdin, say) cannot be mapped, nor can an empty
+    # file, and those are read with an InputReader instead. So is a file
+    # with any \r in it, which the text file turns into \n, so that a
+    # string spanning a CRLF line compiles the same either way.
+    encoding = getattr(file, "encoding", None) or "utf-8"
+    try:
+        if codecs.lookup(encoding).name != "utf-8":
+            return InputReader(file)
+        fd = file.fileno()
+        start = os.lseek(fd, 0, os.SEEK_CUR)
+        import mmap
+        data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return InputReader(file)
+    if data.find(b"\r", start) != -1:
+        data.close()
+        return InputReader(file)
+    return MappedReader(data, start, getattr(file, "errors", None) or "strict")
+
+class MappedReader(InputReader):
+    """An InputReader over bytes already in memory, such as a mapped file"""
+    def __init__(self, data, start=0, errors="strict", fail=fail):
+        InputReader.__init__(self, None, fail)
+        self.cache = data        # all of the input, or None at end of file
+        self.pos = start
+        self.errors = errors     # for decoding, as the file would have
+        self.saved_size = 0      # bytes that saved was decoded from
+        self.literals = {}       # literal -> its bytes
+
+    def set_comments(self, line_comment, block_comment):
+        InputReader.set_comments(self, line_comment, block_comment)
+        openers = [s.encode() for s in comment_openers(line_comment, block_comment)]
+        self.skip_first = WHITESPACE_BYTES | frozenset(s[0] for s in openers)
+        self.skip_re = re.compile(self.skip_re.pattern.encode())
+        self.skip_margin = max([1] + [len(s) for s in openers]) - 1
+
+    def nextline(self):
+        """All of the input is already there, so this is the end of file"""
+        if self.cache is None:
+            self.fail("nextline:end of file")
+        self.ended = self.cache
+        self.cache = None
+
+    def peek(self):
+        """read currently pointed to char (including current lookahead)"""
+        cache = self.cache
+        if cache is None:
+            self.fail("peek:end of file")
+        i = self.pos + self.lookahead
+        if i >= len(cache):
+            return self.nextline()
+        b = cache[i]
+        if b < 0x80:
+            return ASCII_CHARS[b]
+        return cache[i:i+utf8_length(b)].decode("utf-8", self.errors)
+
+    def advance(self, n=1):
+        """Advance lookahead ptr by n chars"""
+        cache = self.cache
+        for k in range(n):
+            i = self.pos + self.lookahead
+            assert i <= len(cache)
+            if i < len(cache):
+                self.lookahead += utf8_length(cache[i])
+            else:
+                self.lookahead += 1
+
+    def save(self, n=None):
+        """Delete n {default lookahead amount) bytes from input stream"""
+        if self.cache is None:
+            return
+        if n is None: n = self.lookahead
+        assert n <= self.lookahead
+        pos = self.pos
+        self.saved = self.cache[pos:pos+n].decode("utf-8", self.errors)
+        self.saved_size = n
+        self.pos = pos + n
+        self.lookahead -= n
+
+    def saved_at(self):
+        return self.pos - self.saved_size
+
+    #----- FAST PATHS ----------------------------------------------------------
+
+    # As in InputReader, but over bytes, handing over to the *_chars()
+    # methods at the end of file, or at any byte that is not ASCII.
+
+    def skipws(self):
+        """skip and consume ws (and comments) on input until we get to next non ws"""
+        cache = self.cache
+        if cache is not None:
+            i = self.pos + self.lookahead
+            if i < len(cache):
+                b = cache[i]
+                if b not in self.skip_first and b < 0x80:
+                    return ASCII_CHARS[b]
+                skips = self.skips
+                if skips is not None and i in skips:
+                    end = skips[i]
+                else:
+                    end = self.skip_re.match(cache, i).end()
+                if end + self.skip_margin < len(cache) and cache[end] < 0x80:
+                    if end != i:
+                        if skips is not None:
+                            skips[i] = end
+                            if len(skips) > SCAN_CACHE_SIZE:
+                                forget_scans(skips)
+                        self.lookahead = end - self.pos
+                        self.save()
+                    return ASCII_CHARS[cache[end]]
+        return self.skipws_chars()
+
+    def id(self):
+        """Try for an identifier"""
+        self.skipws()
+        cache = self.cache
+        if cache is not None:
+            i = self.pos + self.lookahead
+            if i < len(cache) and cache[i] < 0x80:
+                m = ID_BYTES_RE.match(cache, i)
+                if m is None:
+                    self.discard()
+                    return False
+                end = m.end()
+                if end < len(cache) and cache[end] < 0x80:
+                    self.lookahead = end - self.pos
+                    self.save()
+                    return True
+        return self.id_chars()
+
+    def number(self):
+        """Try to read a number"""
+        self.skipws()
+        cache = self.cache
+        if cache is not None:
+            i = self.pos + self.lookahead
+            if i < len(cache) and cache[i] < 0x80:
+                m = NUMBER_BYTES_RE.match(cache, i)
+                if m is None:
+                    self.discard()
+                    return False
+                end = m.end()
+                if end < len(cache) and cache[end] < 0x80:
+                    if cache[end] == 0x2E:  # "."
+                        self.discard()
+                        return False
+                    self.lookahead = end - self.pos
+                    self.save()
+                    return True
+        return self.number_chars()
+
+    def dot_string(self):
+        """Try to read a quoted string"""
+        self.skipws()
+        cache = self.cache
+        if cache is not None:
+            i = self.pos + self.lookahead
+            if i < len(cache):
+                quote = cache[i]
+                if quote not in QUOTE_BYTES:
+                    self.discard()
+                    return False
+                end = cache.find(bytes((quote, )), i+1)
+                if end != -1:
+                    self.lookahead = end + 1 - self.pos
+                    self.save()
+                    return True
+        return self.dot_string_chars()
+
+    def is_literal(self, s):
+        """Try to read a specific literal"""
+        self.skipws()
+        cache = self.cache
+        if cache is not None:
+            b = self.literals.get(s)
+            if b is None:
+                b = self.literals[s] = s.encode("utf-8")
+            i = self.pos + self.lookahead
+            if cache[i:i+len(b)] == b:
+                self.lookahead = i + len(b) - self.pos
+                self.save()
+                return True
+            if i + len(b) <= len(cache):
+                self.discard()
+                return False
+        return self.is_literal_chars(s)
+
+
+#----- SCAN CACHE --------------------------------------------------------------
+
+# A machine that goes back to earlier input positions (a PackratMachine)
+# scans the same text again from there. So its reader remembers, by
+# absolute input position, where each run of whitespace ends (in skips, see
+# skipws()), and what each kind of token found there: where it ended, or -1
+# where there was none. Scanning again from the same place just looks that
+# up, so a cascade of failing alternatives reads each input character once.
+# Literals are not remembered, as comparing one costs no more than looking
+# it up.
+#
+# Without backtracking there is nothing to gain: skipws() consumes what it
+# skips, so the test after a failed one starts where that one stopped.
+#
+# Backtracking only goes back a little way, to where a rule was called, so
+# only the positions scanned most recently are kept: once there are more than
+# SCAN_CACHE_SIZE of one kind, the older half, furthest behind, is forgotten.
+# Scanning there again after all is only a little slower.
+
+SCAN_CACHE_SIZE = 4096  # positions remembered, for each kind of scan
+
+def remember_scans(reader):
+    """Make reader remember what its scans find, by input position"""
+    reader.skips = {}
+    for name in ("id", "number", "dot_string"):
+        setattr(reader, name, cached_scan(reader, getattr(reader, name)))
+
+def forget_scans(ends):
+    """Forget the older half of ends, the positions scanned longest ago"""
+    for where in list(ends)[:len(ends) // 2]:
+        del ends[where]
+
+def cached_scan(reader, scan):
+    """Wrap a token scan of reader, to remember where its token ends"""
+    ends = {}
+    skipws = reader.skipws
+    def scan_cached():
+        skipws()
+        where = reader.base + reader.pos + reader.lookahead
+        end = ends.get(where)
+        if end is None:
+            found = scan()
+            ends[where] = reader.base + reader.pos if found else -1
+            if len(ends) > SCAN_CACHE_SIZE:
+                forget_scans(ends)
+            return found
+        if end < 0:
+            reader.discard()
+            return False
+        reader.lookahead = end - reader.base - reader.pos
+        reader.save()
+        return True
+    return scan_cached
+
+
+#----- EMITTER -----------------------------------------------------------------
+
+def blank_line():
+    """Factory to generate a new blank line"""
+    # The prog column is built up a piece at a time, so it is kept as a list
+    # of pieces and joined once, by out()
+    return ['', []]
+
+F_LABEL      = 0
+F_PROG       = 1
+
+INSTR_INDENT = " " * 9  # print(" "*8, instr) in the original
+OUTPUT_CHUNK = 4096     # lines held by an OutputSink before it writes them
+
+class OutputSink():
+    """Output lines, written out to a file a chunk at a time.
+
+    The file can be any text file, such as sys.stdout or an io.StringIO.
+    Each chunk is flushed through to the file as it is written, so that
+    whatever reads the output sees it while the compilation is still going.
+    """
+    def __init__(self, file, chunk=OUTPUT_CHUNK):
+        self.file = file
+        self.chunk = chunk
+        self.lines = []
+
+    def write_line(self, line):
+        """Add one line of output, without its newline"""
+        lines = self.lines
+        lines.append(line)
+        if len(lines) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        """Write out all of the lines held so far"""
+        if len(self.lines) != 0:
+            self.lines.append("")  # for the newline on the last line
+            self.file.write("\n".join(self.lines))
+            self.file.flush()
+            self.lines = []
+
+
+#----- HOOKS -------------------------------------------------------------------
+
+# Hooks are objects with any of these methods, registered on a MetaMachine
+# with add_hooks(). They are called as:
+#   on_call(rule)                 a rule is called
+#   on_return(rule, switch)       it returns, with the switch set or not
+#   on_token_match(kind, text, pos)
+#                                 TST, ID, NUM or SR matched text, which
+#                                 started at absolute input position pos
+#   on_output_line(line)          a line was output, without its newline
+#   on_fail(context)              the compilation is about to fail
+# Nothing is wrapped, and loop() runs CLL and R inline, unless some hook
+# needs it, so a machine without hooks runs at full speed.
+
+HOOK_EVENTS = ("on_call", "on_return", "on_token_match", "on_output_line",
+               "on_fail")
+
+def hook_tokens(reader, test, kind, hooks):
+    """Wrap a lexer method of reader, to call the hooks when it matches"""
+    def hooked(*args):
+        ok = test(*args)
+        if ok:
+            text = reader.saved
+            for hook in hooks:
+                hook(kind, text, reader.saved_at())
+        return ok
+    return hooked
+
+
+#===== META-II MACHINE =========================================================
+
+# Stack frames that label cells are allocated for at first (see STACK below)
+STACK_FRAMES = 256
+
+class MetaMachine():
+    """All of the state of a META-II compilation.
+
+    A machine can run any number of compilations, one after the other,
+    and several machines can be used at once in one process.
+    """
+    # loop() runs CLL and R inline, unless a subclass that needs to follow
+    # rule calls sets this and overrides call() and ret()
+    follow_calls = False
+    # set by a subclass that goes back to earlier input positions, to have
+    # the reader remember its scans (see SCAN CACHE)
+    cache_scans = False
+
+    def __init__(self, flush_lines=OUTPUT_CHUNK):
+        self.prog = None
+        self.flush_lines = flush_lines  # output lines written out at a time
+        self.hooks = dict((event, []) for event in HOOK_EVENTS)
+        self.names = {}  # rule ip -> rule name, for hooks and profiles
+        self.reset()
+
+    def reset(self, infile=None, outfile=None):
+        """Clear all per-compilation state, ready for a new input"""
+        if isinstance(infile, InputReader):
+            self.reader = infile
+            infile.fail = self.fail
+        else:
+            self.reader = InputReader(infile, self.fail)
+        prog = self.prog
+        if prog is not None and (prog.line_comment is not None
+                                 or prog.block_comment is not None):
+            self.reader.set_comments(prog.line_comment, prog.block_comment)
+        if self.cache_scans:
+            remember_scans(self.reader)  # before any hooks wrap the scans
+        self.outfile = outfile
+        if isinstance(outfile, OutputSink):
+            self.sink = outfile
+        else:
+            self.sink = OutputSink(outfile, self.flush_lines)
+        self.install_hooks()
+
+        # VM program executor
+        self.ip = 0  # current index into prog.instrs[]
+        self.switch = False
+        self.finished = False
+
+        # label sequence generator
+        self.labels = []
+
+        # stack: the return address of each frame, and its label cells
+        self.stack = []
+        self.cells = [[None] * STACK_FRAMES, [None] * STACK_FRAMES]
+        self.labelled = []  # the frames with label cells set, bottom first
+        self.called = []  # names of the rules called, when follow_calls
+
+        # emitter
+        self.field_idx = F_PROG
+        self.current_line = blank_line()
+
+    def compile(self, prog, input) -> str:
+        """Compile input (a str or a file) with prog, returning the output.
+
+        prog is a Program from load_program(), or None to use the built-in
+        META-II compiler.
+        """
+        if isinstance(input, str):
+            input = io.StringIO(input)
+        output = io.StringIO()
+        self.run(prog, input, output)
+        return output.getvalue()
+
+    def run(self, prog, infile, outfile) -> None:
+        """Compile infile, writing the output to outfile (a file or a sink)"""
+        if prog is None:
+            prog = builtin_program()
+        if prog is not self.prog:
+            self.names = {}
+        self.prog = prog
+        self.reset(infile, outfile)
+
+        try:
+            if prog.native is not None and not self.follow_calls:
+                ok = self.run_native()
+            else:
+                ok = self.loop()
+
+            if not ok:
+                self.fail("run:incomplete")
+            else:
+                self.sink.write_line("")
+        finally:
+            # on failure too, so that the output stops where it always has
+            self.sink.flush()
+
+    #----- HOOKS ---------------------------------------------------------------
+
+    def add_hooks(self, hooks):
+        """Register hooks, from the next compilation on"""
+        for event in HOOK_EVENTS:
+            fn = getattr(hooks, event, None)
+            if fn is not None:
+                self.hooks[event].append(fn)
+
+    def remove_hooks(self, hooks):
+        """Unregister hooks that add_hooks() registered"""
+        for event in HOOK_EVENTS:
+            fn = getattr(hooks, event, None)
+            if fn is not None and fn in self.hooks[event]:
+                self.hooks[event].remove(fn)
+
+    def install_hooks(self):
+        """Wrap the new reader and sink, as far as the hooks need to"""
+        hooks = self.hooks
+        self.follow_calls = type(self).follow_calls or \
+            len(hooks["on_call"]) != 0 or len(hooks["on_return"]) != 0
+
+        matched = hooks["on_token_match"]
+        if len(matched) != 0:
+            reader = self.reader
+            for method, kind in (("is_literal", "TST"), ("id", "ID"),
+                                 ("number", "NUM"), ("dot_string", "SR")):
+                setattr(reader, method,
+                        hook_tokens(reader, getattr(reader, method), kind, matched))
+
+        output = hooks["on_output_line"]
+        if len(output) != 0:
+            sink = self.sink
+            write_line = sink.write_line
+            def hooked_write_line(line):
+                for hook in output:
+                    hook(line)
+                write_line(line)
+            sink.write_line = hooked_write_line
+
+    #----- ERROR HANDLING ------------------------------------------------------
+
+    def fail(self, context="", listing=""):
+        """Raise a fatal error and stop"""
+        for hook in self.hooks["on_fail"]:
+            hook(context)
+        if self.prog is None:
+            ip_to_lineno = None
+        else:
+            ip_to_lineno = self.prog.ip_to_lineno
+        fail(context, self.ip, ip_to_lineno, self.format_m2_stack(), listing)
+
+    def format_m2_stack(self):
+        lines = []
+        for item in self.stack:
+            try:
+                lines.append(str(item) + str(self.prog.instrs[item])) # the thing we called
+            except:
+                lines.append("?")
+        return lines
+
+    #----- LABEL SEQUENCE GENERATOR --------------------------------------------
+
+    def nextlabel(self, index=1):
+        """Allocate the next label for a given sequence"""
+        labels = self.labels
+        while index > len(labels):
+            labels.append(None)
+        index -= 1 # 1.. => A..
+
+        if labels[index] is None:
+            labels[index] = 1
+        else:
+            labels[index] += 1
+
+        return format("%c%02d" % (chr(ord('A') + index), labels[index]))
+
+    def gen(self, index=1):
+        """Generate or read current sequence for a given index"""
+        v = self.rd_local(index)
+        if v is None:
+            v = self.nextlabel(index)
+            self.wr_local(index, v)
+        return v
+
+    def gen1(self):
+        """Generate label 1"""
+        # This concerns the current label 1 cell.
+        # i.e. the next to top cell in the stack,
+        # which is either clear or contains a generated label.
+        # If clear, generate a label and put it into that cell.
+        # Whether the label has just been put into the cell or was already there,
+        # output it.
+        # finally, insert a blank character in the output following the label.
+        self.dot_out(self.gen(1))
+
+    def gen2(self):
+        """Generate label 2"""
+        # This concerns the current label 2 cell.
+        # i.e. the top cell in the stack,
+        # which is either clear or contains a generated label.
+        # If clear, generate a label and put it into that cell.
+        # Whether the label has just been put into the cell or was already there,
+        # output it.
+        # finally, insert a blank character in the output following the label.
+        self.dot_out(self.gen(2))
+
+    #----- STACK ---------------------------------------------------------------
+
+    # Each frame is just its return address, on self.stack, which CLL and R
+    # push and pop inline. Its label cells are kept in self.cells, one list for
+    # each label, indexed by the frame's depth, and are only cleared when the
+    # frame is popped if they were set (self.labelled says which were). So
+    # nothing is allocated for a call, and only GN1 and GN2 touch the cells.
+    # The depth of a frame is len(self.stack) while it runs: the top level,
+    # with nothing on the stack, is depth 0 and has cells of its own.
+
+    def pop_frame(self):
+        """Pop the top stack frame, returning its return address"""
+        stack = self.stack
+        retaddr = stack.pop()
+        labelled = self.labelled
+        if len(labelled) != 0 and labelled[-1] > len(stack):
+            self.clear_cells()
+        return retaddr
+
+    def clear_cells(self):
+        """Clear the label cells of the frame just popped"""
+        depth = self.labelled.pop()
+        for cells in self.cells:
+            cells[depth] = None
+
+    def rd_local(self, index=1):
+        """Read the value of a given local variable index"""
+        # locals numbered from 1
+        depth = len(self.stack)
+        if index > len(self.cells) or depth >= len(self.cells[0]):
+            return None
+        return self.cells[index-1][depth]
+
+    def wr_local(self, index=1, value="NONE"):
+        """Write a new value to a given local variable index"""
+        # locals numbered from 1
+        depth = len(self.stack)
+        cells = self.cells
+        if depth >= len(cells[0]):
+            size = len(cells[0])
+            while depth >= size:
+                size *= 2
+            for c in cells:
+                c.extend([None] * (size - len(c)))
+        while index > len(cells):
+            cells.append([None] * len(cells[0]))
+        cells[index-1][depth] = value
+
+        labelled = self.labelled
+        if len(labelled) == 0 or labelled[-1] != depth:
+            labelled.append(depth)
+
+    #----- EMITTER -------------------------------------------------------------
+
+    def to_label(self):
+        """Next dot_out() will be to the label column"""
+        assert self.field_idx != F_LABEL, "to_label: already in label field"
+        self.field_idx = F_LABEL
+
+    def to_prog(self):
+        """Next dot_out() will be to the prog column"""
+        self.field_idx = F_PROG
+
+    def dot_out(self, s):
+        """Write string to output"""
+        if self.field_idx == F_LABEL:
+            self.current_line[F_LABEL] = s
+            self.to_prog()
+        else:
+            self.current_line[F_PROG].append(s)
+
+    def out(self):
+        """Output current line and move to next output line"""
+        current_line = self.current_line
+        if len(current_line[0]) != 0:
+            # A label line
+            self.sink.write_line(current_line[0])
+            assert len(current_line[1]) == 0, "out: label and instr on same line? %s" % str(current_line)
+        else:
+            # An instruction line
+            self.sink.write_line(INSTR_INDENT + "".join(current_line[1]).strip())
+        self.current_line = blank_line()
+        self.to_prog()
+
+    #----- VIRTUAL MACHINE INSTRUCTION INTERPRETER -----------------------------
+
+    def loop(self, ip=0) -> bool:
+        """FETCH/DECODE/EXECUTE loop, over the linked ops[] and args[]"""
+        ops = self.prog.ops
+        args = self.prog.args
+        stack = self.stack
+        labelled = self.labelled
+        reader = self.reader
+        is_literal = reader.is_literal
+        id = reader.id
+        dot_out = self.dot_out
+        out = self.out
+        follow_calls = self.follow_calls
+
+        switch = False
+        finished = False
+
+        # Opcodes are tested roughly in order of how often they are executed.
+        # Every operand has been decoded by link(), so nothing is looked up
+        # here. self.ip is only kept up to date where fail() might need it.
+        while not finished:
+            op = ops[ip]
+            arg = args[ip]
+            ip += 1
+
+            if op == OP_BT:
+                # BRANCH IF TRUE - Branch if true
+                # Branch to location aaa if switch is ON.
+                # Otherwise, continue in sequence.
+                if switch:
+                    ip = arg
+
+            elif op == OP_BF:
+                # BRANCH IF FALSE - Branch if false
+                # Branch to location aaa if switch is OFF.
+                # Otherwise, continue in sequence.
+                if not switch:
+                    ip = arg
+
+            elif op == OP_R:
+                # RETURN - Return to caller
+                # Return to the exit address, popping up the stack by one or
+                # three cells according to the flag.
+                # If the stack is popped by only one cell, then clear the top
+                # two cells to blanks, because they were blank when the
+                # subroutine was entered.
+                if len(stack) == 0:
+                    finished = True
+                elif not follow_calls:
+                    ip = stack.pop()
+                    if len(labelled) != 0 and labelled[-1] > len(stack):
+                        self.clear_cells()
+                else:
+                    ip = self.ret(switch)
+
+            elif op == OP_CLL:
+                # CALL - Call Subroutine
+                # Enter the subroutine beginning in location aaa.
+                # If the top two terms of the stack are blank,
+                # push the stack down by one cell.
+                # Otherwise, push it down by three cells.
+                # Set a flag in the stack to indicate where it has been pushed
+                # by one or three cells.
+                # This flag and the exit address go into the third cell.
+                # Clear the top two cells to blanks to indicate that they can
+                # accept addresses which may be generated within the subroutine.
+                if not follow_calls:
+                    stack.append(ip)  # return address
+                    ip = arg
+                else:
+                    ip, switch = self.call(ip, arg, switch)
+
+            elif op == OP_DSP:
+                # DISPATCH - Go straight to the alternative that can match
+                # Not a META-II instruction: add_dispatch() puts it in place
+                # of the test at the head of a chain of alternatives.
+                # After deleting initial blanks in the input string, look up
+                # the next character. Jump to the first alternative that
+                # could match it, or past them all with the switch reset.
+                # If that is the first alternative, do its own test here.
+                self.ip = ip
+                table, default, op, arg = arg
+                ch = reader.skipws()
+                target = ip - 1
+                if ch < "\x80":
+                    target = table.get(ch, default)
+                if target != ip - 1:
+                    switch = False
+                    ip = target
+                elif op == OP_TST:
+                    switch = is_literal(arg)
+                elif op == OP_ID:
+                    switch = id()
+                elif op == OP_NUM:
+                    switch = reader.number()
+                elif op == OP_SR:
+                    switch = reader.dot_string()
+                elif not follow_calls:  # OP_CLL
+                    stack.append(ip)  # return address
+                    ip = arg
+                else:
+                    ip, switch = self.call(ip, arg, switch)
+
+            elif op == OP_TST_BF:
+                # TEST, BRANCH IF FALSE - superinstruction, see fuse()
+                self.ip = ip
+                switch = is_literal(arg[0])
+                if switch:
+                    ip += 1
+                else:
+                    ip = arg[1]
+
+            elif op == OP_CL_OUT:
+                # COPY LITERAL, OUTPUT - superinstruction
+                dot_out(arg[0])
+                out()
+                ip += 1
+
+            elif op == OP_SET_BE:
+                # SET, BRANCH TO ERROR IF FALSE - superinstruction
+                # The BE can never halt.
+                switch = True
+                ip += 1
+
+            elif op == OP_BE:
+                # BRANCH TO ERROR IF FALSE - Branch if false to error handler
+                # Halt if switch is OFF.
+                # Otherwise, continue in sequence.
+                if not switch:
+                    self.ip = ip
+                    ip = self.rule_error()
+
+            elif op == OP_GN1_OUT:
+                # GENERATE 1, OUTPUT - superinstruction
+                self.gen1()
+                out()
+                ip += 1
+
+            elif op == OP_TST_BE:
+                # TEST, BRANCH TO ERROR IF FALSE - superinstruction
+                self.ip = ip
+                switch = is_literal(arg[0])
+                ip += 1
+                if not switch:
+                    self.ip = ip
+                    ip = self.rule_error()
+
+            elif op == OP_OUT_R:
+                # OUTPUT, RETURN - superinstruction
+                out()
+                if len(stack) == 0:
+                    finished = True
+                elif not follow_calls:
+                    ip = stack.pop()
+                    if len(labelled) != 0 and labelled[-1] > len(stack):
+                        self.clear_cells()
+                else:
+                    ip = self.ret(switch)
+
+            elif op == OP_BE_R:
+                # BRANCH TO ERROR IF FALSE, RETURN - superinstruction
+                if not switch:
+                    self.ip = ip
+                    ip = self.rule_error()
+                elif len(stack) == 0:
+                    finished = True
+                elif not follow_calls:
+                    ip = stack.pop()
+                    if len(labelled) != 0 and labelled[-1] > len(stack):
+                        self.clear_cells()
+                else:
+                    ip = self.ret(switch)
+
+            elif op == OP_CL:
+                # COPY LITERAL - Copy literal
+                # Output the variable length string given as the argument.
+                # A blank character will be inserted in the output following
+                # the string (link() has already added it).
+                dot_out(arg)
+
+            elif op == OP_CL_CI:
+                # COPY LITERAL, COPY INPUT - superinstruction
+                dot_out(arg[0])
+                dot_out(reader.saved)
+                ip += 1
+
+            elif op == OP_LB:
+                # LABEL - Next write is to label field
+                # Set the output counter to card column 1.
+                self.to_label()
+
+            elif op == OP_OUT:
+                # OUTPUT - output current line
+                # punch card and reset output counter to card column 8.
+                out()
+
+            elif op == OP_SET:
+                # SET - Set switch
+                # Set branch switch ON.
+                switch = True
+
+            elif op == OP_SR_BF:
+                # STRING, BRANCH IF FALSE - superinstruction
+                self.ip = ip
+                switch = reader.dot_string()
+                if switch:
+                    ip += 1
+                else:
+                    ip = arg[1]
+
+            elif op == OP_GN1:
+                # GENERATE 1 - Generate label 1
+                # This concerns the current label 1 cell.
+                # i.e. The next to top cell in the stack, which is either clear
+                # or contains a generated label.
+                # If clear, generate a label and put it into that cell.
+                # Whether the label has just been put into the cell or was
+                # already there, output it.
+                self.gen1()
+
+            elif op == OP_GN2:
+                # GENERATE 2 - Generate label 2
+                # Same as GN1, except that it concerns the current label 2 cell.
+                # i.e. the top cell in the stack.
+                self.gen2()
+
+            elif op == OP_ID_BF:
+                # IDENTIFIER, BRANCH IF FALSE - superinstruction
+                self.ip = ip
+                switch = id()
+                if switch:
+                    ip += 1
+                else:
+                    ip = arg[1]
+
+            elif op == OP_NUM:
+                # NUMBER - Try for a number
+                # After deleting initial blanks in the input string,
+                # test if it begins with a number.
+                # A number is a string of digits which may contain embedded
+                # periods, but may not begin or end with a period.
+                # No two periods may be next to one another.
+                # If a number is found, delete it and set switch.
+                # If not, reset switch.
+                self.ip = ip
+                switch = reader.number()
+
+            elif op == OP_CI:
+                # COPY INPUT - Copy saved input to output
+                # Output the last sequence of characters deleted from the input
+                # string. This command may not function properly if the last
+                # command which could cause deletion failed to do so.
+                dot_out(reader.saved)
+
+            elif op == OP_SR:
+                # STRING - Try for a quoted string
+                # After deleting initial blanks in the input string,
+                # test if it begins with a string.
+                # i.e. a single quote followed by a sequence of any characters
+                # other than a single quote, followed by another single quote.
+                # If a string is found, delete it and set the switch.
+                # If not, reset switch.
+                self.ip = ip
+                switch = reader.dot_string()
+
+            elif op == OP_ID:
+                # IDENTIFIER - Try for an identifier
+                # After deleting initial blanks in the input string,
+                # test if it begins with an identifier.
+                # i.e. A letter followed by a sequence of letters and/or digits.
+                # If so delete the identifier and set the switch.
+                # If not, reset switch.
+                self.ip = ip
+                switch = id()
+
+            elif op == OP_TST:
+                # TEST - Try for a specific literal
+                # After deleting initial blanks in the input string,
+                # compare it to the string given as argument.
+                # If the comparision is met, delete the matched portion from
+                # the input and set the switch.
+                # If not met, reset switch.
+                self.ip = ip
+                switch = is_literal(arg)
+
+            elif op == OP_B:
+                # BRANCH - Branch unconditional
+                # Branch unconditionally to location aaa.
+                ip = arg
+
+            elif op == OP_END:
+                # END - Finish machine
+                # Denotes the end of the program.
+                finished = True
+
+        self.ip = ip
+        self.switch = switch
+        self.finished = finished
+        return switch
+
+    def call(self, ip, rule, switch):
+        """CLL, returning the next ip and switch"""
+        self.stack.append(ip)  # return address
+        name = self.rule_name(rule)
+        self.called.append(name)
+        for hook in self.hooks["on_call"]:
+            hook(name)
+        return rule, switch
+
+    def ret(self, switch):
+        """R from a rule call, returning the next ip"""
+        name = self.called.pop()
+        for hook in self.hooks["on_return"]:
+            hook(name, switch)
+        return self.pop_frame()
+
+    def rule_name(self, ip):
+        """The name of the rule at ip"""
+        name = self.names.get(ip)
+        if name is None:
+            name = self.names[ip] = rule_name(self.prog, ip)
+        return name
+
+    def rule_error(self):
+        """BE with the switch off: halt, or return the ip to go on at"""
+        self.fail("BE:branch to error executed", self.prog.format_instrs())
+
+    def run_native(self) -> bool:
+        """Run the program's native (translated to Python) form"""
+        # Each rule call is a Python call, so deep enough nesting in the input
+        # runs out of Python's stack, where loop() would have gone on.
+        entry = self.prog.native(self)
+        try:
+            return entry()
+        except Finished as e:
+            return e.switch
+        except RecursionError:
+            self.fail("native:input nested too deeply for Python, run it without --native")
+
+
+#===== BUILT-IN META-II COMPILER ===============================================
+
+# The built-in compiler is META-II written in its own VM code: the meta.meta
+# that it compiles meta.spec into, as make self checks. So it runs on the VM
+# like any other program, with its rule calls on the machine's stack rather
+# than on Python's, and copes with grammars nested to any depth.
+
+META_II = """\
+         B PROGRAM
+OUT1
+         TST '*1'
+         BF A01
+         CL 'GN1'
+         OUT
+A01
+         BT A02
+         TST '*2'
+         BF A03
+         CL 'GN2'
+         OUT
+A03
+         BT A02
+         TST '*'
+         BF A04
+         CL 'CI'
+         OUT
+A04
+         BT A02
+         SR
+         BF A05
+         CL 'CL'
+         CI
+         OUT
+A05
+A02
+         R
+OUTPUT
+         TST '.OUT'
+         BF A06
+         TST '('
+         BE
+A07
+         CLL OUT1
+         BT A07
+         SET
+         BE
+         TST ')'
+         BE
+A06
+         BT A08
+         TST '.LABEL'
+         BF A09
+         CL 'LB'
+         OUT
+         CLL OUT1
+         BE
+A09
+A08
+         BF A10
+         CL 'OUT'
+         OUT
+A10
+A11
+         R
+EX3
+         ID
+         BF A12
+         CL 'CLL'
+         CI
+         OUT
+A12
+         BT A13
+         SR
+         BF A14
+         CL 'TST'
+         CI
+         OUT
+A14
+         BT A13
+         TST '.ID'
+         BF A15
+         CL 'ID'
+         OUT
+A15
+         BT A13
+         TST '.NUMBER'
+         BF A16
+         CL 'NUM'
+         OUT
+A16
+         BT A13
+         TST '.STRING'
+         BF A17
+         CL 'SR'
+         OUT
+A17
+         BT A13
+         TST '('
+         BF A18
+         CLL EX1
+         BE
+         TST ')'
+         BE
+A18
+         BT A13
+         TST '.EMPTY'
+         BF A19
+         CL 'SET'
+         OUT
+A19
+         BT A13
+         TST '$'
+         BF A20
+         LB
+         GN1
+         OUT
+         CLL EX3
+         BE
+         CL 'BT'
+         GN1
+         OUT
+         CL 'SET'
+         OUT
+A20
+A13
+         R
+EX2
+         CLL EX3
+         BF A21
+         CL 'BF'
+         GN1
+         OUT
+A21
+         BT A22
+         CLL OUTPUT
+         BF A23
+A23
+A22
+         BF A24
+A25
+         CLL EX3
+         BF A26
+         CL 'BE'
+         OUT
+A26
+         BT A27
+         CLL OUTPUT
+         BF A28
+A28
+A27
+         BT A25
+         SET
+         BE
+         LB
+         GN1
+         OUT
+A24
+A29
+         R
+EX1
+         CLL EX2
+         BF A30
+A31
+         TST '/'
+         BF A32
+         CL 'BT'
+         GN1
+         OUT
+         CLL EX2
+         BE
+A32
+A33
+         BT A31
+         SET
+         BE
+         LB
+         GN1
+         OUT
+A30
+A34
+         R
+ST
+         ID
+         BF A35
+         LB
+         CI
+         OUT
+         TST '='
+         BE
+         CLL EX1
+         BE
+         TST ';'
+         BE
+         CL 'R'
+         OUT
+A35
+A36
+         R
+PROGRAM
+         TST '.SYNTAX'
+         BF A37
+         ID
+         BE
+         CL 'B'
+         CI
+         OUT
+A38
+         CLL ST
+         BT A38
+         SET
+         BE
+         TST '.END'
+         BE
+         CL 'END'
+         OUT
+A37
+A39
+         R
+         END
+"""
+
+# The built-in compiler, once it has been loaded and linked
+builtin_prog = None
+
+def builtin_program() -> Program:
+    """The linked Program of the built-in META-II compiler"""
+    global builtin_prog
+    if builtin_prog is None:
+        prog = Program()
+        prog.load_instrs(io.StringIO(META_II))
+        prog.link()
+        builtin_prog = prog
+    return builtin_prog
+
+
+#----- PACKRAT MACHINE ---------------------------------------------------------
+
+# In packrat mode a rule that fails part way through, at a BE, no longer
+# stops the compilation. Instead the input, the output and the label
+# counters go back to how they were when the rule was called, and the call
+# returns false, so that the caller can go on to try its next alternative.
+#
+# The result of every rule call is remembered against the rule, the input
+# position and the saved text it was called with, so calling the same rule
+# at the same place again replays the result instead of parsing again,
+# which keeps backtracking grammars linear-time. A result holds the output
+# ops of the call and the label counters around it, so that the labels it
+# generated are renumbered when it is replayed after different ones.
+# Each result holds its own copy of that output, and a call's output takes
+# in all of the calls it made, so the memo is bounded by the output its
+# results hold in all, as well as by how many there are.
+#
+# While any rule call is active its output is kept in a log, as it might
+# yet be taken back. Whenever the outermost call returns, the log goes to
+# the real emitter.
+
+MEMO_SIZE = 100000  # rule results remembered, the oldest are forgotten first
+MEMO_OPS  = 500000  # output log entries that those results may hold in all
+
+LOG_OUT = 0  # log entry for OUT, other entries are text or (index, n) labels
+LOG_LB  = 1  # log entry for LB
+
+class PackratMachine(MetaMachine):
+    """A MetaMachine that backtracks failed rule calls, and memoizes them"""
+    follow_calls = True
+    cache_scans = True
+
+    def __init__(self, flush_lines=OUTPUT_CHUNK, memo_size=MEMO_SIZE,
+                 memo_ops=MEMO_OPS):
+        self.memo_size = memo_size
+        self.memo_ops = memo_ops
+        MetaMachine.__init__(self, flush_lines)
+
+    def reset(self, infile=None, outfile=None):
+        MetaMachine.reset(self, infile, outfile)
+        # (rule ip, position, saved) -> result of the call, oldest first
+        self.memo = collections.OrderedDict()
+        self.memo_held = 0  # output log entries held by the results in memo
+        self.marks = []  # state at the start of each active call, by frame
+        self.log = []    # output ops of the active calls
+
+    #----- LABELS --------------------------------------------------------------
+
+    def gen(self, index=1):
+        """Generate or read current label, as (index, n) for the log"""
+        v = self.rd_local(index)
+        if v is None:
+            self.nextlabel(index)
+            v = (index-1, self.labels[index-1])
+            self.wr_local(index, v)
+        return v
+
+    def counters(self):
+        """The label counters, as a tuple of two ints"""
+        labels = self.labels + [None, None]
+        return (labels[0] or 0, labels[1] or 0)
+
+    #----- EMITTER -------------------------------------------------------------
+
+    def to_label(self):
+        self.dot_out(LOG_LB)
+
+    def out(self):
+        self.dot_out(LOG_OUT)
+
+    def dot_out(self, s):
+        if len(self.marks) != 0:
+            self.log.append(s)
+        else:
+            self.emit(s)
+
+    def emit(self, e):
+        """Send one log entry to the real emitter"""
+        if type(e) is str:
+            MetaMachine.dot_out(self, e)
+        elif type(e) is tuple:
+            MetaMachine.dot_out(self, "%c%02d" % (chr(ord('A') + e[0]), e[1]))
+        elif e == LOG_OUT:
+            MetaMachine.out(self)
+        else:
+            MetaMachine.to_label(self)
+
+    def commit(self):
+        """No call is active any more, so its output can no longer change"""
+        for e in self.log:
+            self.emit(e)
+        self.log = []
+        self.reader.keep = None
+
+    #----- RULE CALLS ----------------------------------------------------------
+
+    def call(self, ip, rule, switch):
+        """CLL: replay a remembered result, or enter the rule"""
+        reader = self.reader
+        key = (rule, reader.tell(), reader.saved)
+        result = self.memo.get(key)
+        if result is not None:
+            return ip, self.replay(result)
+
+        if len(self.marks) == 0:
+            reader.keep = key[1]
+        self.marks.append((key, len(self.log), self.counters()))
+        return MetaMachine.call(self, ip, rule, switch)
+
+    def ret(self, switch):
+        """R: remember the result of the call that is returning"""
+        ip = MetaMachine.ret(self, switch)
+        key, log_len, labels = self.marks.pop()
+        reader = self.reader
+        self.remember(key, (switch, reader.tell(), reader.saved,
+                            self.log[log_len:], labels, self.counters()))
+        if len(self.marks) == 0:
+            self.commit()
+        return ip
+
+    def rule_error(self):
+        """BE: take back the current call, which then returns false"""
+        if len(self.stack) == 0:
+            return MetaMachine.rule_error(self)
+        ip = MetaMachine.ret(self, False)
+        key, log_len, labels = self.marks.pop()
+        rule, pos, saved = key
+        self.reader.seek(pos, saved)
+        del self.log[log_len:]
+        self.labels[:] = labels
+        self.remember(key, (False, pos, saved, [], labels, labels))
+        if len(self.marks) == 0:
+            self.commit()
+        return ip
+
+    def remember(self, key, result):
+        memo = self.memo
+        old = memo.pop(key, None)
+        if old is not None:
+            self.memo_held -= len(old[3])
+        ops = len(result[3])
+        if ops > self.memo_ops // 2:
+            return  # it would push out most of the others
+        memo[key] = result
+        self.memo_held += ops
+        while len(memo) > self.memo_size or self.memo_held > self.memo_ops:
+            key, old = memo.popitem(last=False)  # the oldest
+            self.memo_held -= len(old[3])
+
+    def replay(self, result) -> bool:
+        """Repeat a remembered call, returning its switch"""
+        switch, pos, saved, ops, before, after = result
+        self.reader.skip_to(pos, saved)
+
+        now = self.counters()
+        if now != before:
+            # renumber the labels that the call generated
+            shift = (now[0] - before[0], now[1] - before[1])
+            ops = [(e[0], e[1] + shift[e[0]]) if type(e) is tuple else e
+                   for e in ops]
+            after = (after[0] + shift[0], after[1] + shift[1])
+        self.labels[:] = after
+
+        if len(self.marks) != 0:
+            self.log.extend(ops)
+        else:
+            for e in ops:
+                self.emit(e)
+        return switch
+
+
+#----- PROFILER ----------------------------------------------------------------
+
+# A ProfilingMachine times every rule call, and counts the token tests made
+# within each rule, as they run on the VM. Time spent outside of any rule
+# call goes to TOP_RULE. The collapsed stacks are the rule call stacks, as
+# "(top);BLOCK;ST;IOST 1234" lines giving the exclusive time in
+# microseconds, ready for flamegraph.pl and the like.
+
+TOP_RULE = "(top)"
+TOKEN_KINDS = ("TST", "ID", "NUM", "SR")
+
+class RuleProfile():
+    """What a ProfilingMachine knows about one rule"""
+    def __init__(self):
+        self.calls = 0
+        self.inclusive = 0.0  # seconds, not counting recursive calls twice
+        self.exclusive = 0.0  # seconds, not counting the rules it called
+        self.active = 0       # calls in progress
+        self.tries = dict((kind, 0) for kind in TOKEN_KINDS)
+        self.matches = dict((kind, 0) for kind in TOKEN_KINDS)
+        self.rescanned = 0    # characters peeked and then discarded
+
+class ProfilingMachine(MetaMachine):
+    """A MetaMachine that profiles the rules of the programs it runs"""
+    follow_calls = True
+
+    def __init__(self, flush_lines=OUTPUT_CHUNK):
+        self.rules = {}        # rule name -> RuleProfile
+        self.collapsed = {}    # "TOP;RULE;..." -> exclusive microseconds
+        self.frames = []       # [profile, path, start, time in callees]
+        MetaMachine.__init__(self, flush_lines)
+
+    def reset(self, infile=None, outfile=None):
+        MetaMachine.reset(self, infile, outfile)
+        reader = self.reader
+        self.count_tokens(reader, "is_literal", "TST")
+        self.count_tokens(reader, "id", "ID")
+        self.count_tokens(reader, "number", "NUM")
+        self.count_tokens(reader, "dot_string", "SR")
+
+    def count_tokens(self, reader, method, kind):
+        """Wrap a lexer method of reader to count its tries and matches"""
+        # The fast paths find out that a test fails without reading on, so
+        # what a failed test read is worked out here instead: as far as the
+        # one character at a time code would have got before it gave up.
+        # An identifier or a string gives up on its first character.
+        test = getattr(reader, method)
+        def counted(*args):
+            profile = self.frames[-1][0]
+            profile.tries[kind] += 1
+            ok = test(*args)
+            if ok:
+                profile.matches[kind] += 1
+            elif kind == "TST":
+                profile.rescanned += reader.prefix_length(args[0])
+            elif kind == "NUM":
+                profile.rescanned += reader.number_length()
+            return ok
+        setattr(reader, method, counted)
+
+    def run(self, prog, infile, outfile) -> None:
+        self.enter(TOP_RULE)
+        try:
+            MetaMachine.run(self, prog, infile, outfile)
+        finally:
+            # after a failure, every rule still active is left here
+            while len(self.frames) != 0:
+                self.leave()
+
+    #----- RULE CALLS ----------------------------------------------------------
+
+    def enter(self, name):
+        profile = self.rules.get(name)
+        if profile is None:
+            profile = self.rules[name] = RuleProfile()
+        profile.calls += 1
+        profile.active += 1
+        if len(self.frames) == 0:
+            path = name
+        else:
+            path = self.frames[-1][1] + ";" + name
+        self.frames.append([profile, path, time.perf_counter(), 0.0])
+
+    def leave(self):
+        profile, path, start, callees = self.frames.pop()
+        elapsed = time.perf_counter() - start
+        profile.active -= 1
+        if profile.active == 0:
+            profile.inclusive += elapsed
+        profile.exclusive += elapsed - callees
+        self.collapsed[path] = self.collapsed.get(path, 0) + \
+                               (elapsed - callees) * 1e6
+        if len(self.frames) != 0:
+            self.frames[-1][3] += elapsed
+
+    def call(self, ip, rule, switch):
+        self.enter(self.rule_name(rule))
+        return MetaMachine.call(self, ip, rule, switch)
+
+    def ret(self, switch):
+        self.leave()
+        return MetaMachine.ret(self, switch)
+
+    #----- REPORTS -------------------------------------------------------------
+
+    def write_report(self, file):
+        """Write a table of the rules, the most exclusive time first"""
+        file.write("%-16s %8s %10s %10s" % ("rule", "calls", "incl ms", "excl ms"))
+        for kind in TOKEN_KINDS:
+            file.write(" %13s" % (kind + " ok/tries"))
+        file.write(" %9s\n" % "rescanned")
+
+        rules = sorted(self.rules.items(), key=lambda r: -r[1].exclusive)
+        for name, p in rules:
+            file.write("%-16s %8d %10.1f %10.1f" % (name, p.calls,
+                       p.inclusive * 1000, p.exclusive * 1000))
+            for kind in TOKEN_KINDS:
+                file.write(" %13s" % ("%d/%d" % (p.matches[kind], p.tries[kind])))
+            file.write(" %9d\n" % p.rescanned)
+
+    def write_collapsed(self, file):
+        """Write the collapsed stacks, for a flamegraph"""
+        for path, us in sorted(self.collapsed.items()):
+            file.write("%s %d\n" % (path, round(us)))
+
+
+#----- STREAMING ---------------------------------------------------------------
+
+# iter_compile() runs the compilation in a thread of its own, which passes
+# the output over a bounded queue a chunk at a time. When the queue is full
+# the compiler waits for the consumer to catch up, so the output is never all
+# held in memory at once.
+
+STREAM_CHUNK = 256  # output lines passed over at a time
+STREAM_DEPTH = 4    # chunks that the compiler can get ahead of the consumer
+
+class Cancelled(Exception):
+    """Stops a compilation whose iter_compile() consumer has gone away"""
+    pass
+
+class QueueSink(OutputSink):
+    """An OutputSink that passes each chunk of lines to another thread"""
+    def __init__(self, chunk=STREAM_CHUNK, depth=STREAM_DEPTH):
+        import queue
+        OutputSink.__init__(self, None, chunk)
+        self.queue = queue.Queue(depth)
+        self.cancelled = False  # set by the consumer when it stops reading
+
+    def flush(self):
+        if len(self.lines) != 0:
+            self.put(("lines", self.lines))
+            self.lines = []
+
+    def put(self, item):
+        """Queue an item, waiting for room, unless the consumer has gone"""
+        import queue
+        while True:
+            if self.cancelled:
+                raise Cancelled()
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+def iter_compile(prog, input, chunk=STREAM_CHUNK, depth=STREAM_DEPTH):
+    """Compile input (a str or a file) with prog, yielding the output lines.
+
+    Each line keeps its newline, so joining them gives what compile() would
+    return. If the compilation fails, the lines output up to that point are
+    yielded and then its MetaError is raised. Closing the generator early
+    stops the compilation.
+    """
+    if isinstance(input, str):
+        input = io.StringIO(input)
+    sink = QueueSink(chunk, depth)
+
+    def produce():
+        try:
+            MetaMachine().run(prog, input, sink)
+            sink.put(("done", None))
+        except Cancelled:
+            pass
+        except Exception as e:
+            try:
+                sink.put(("error", e))
+            except Cancelled:
+                pass
+
+    import threading
+    thread = threading.Thread(target=produce, name="iter_compile", daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = sink.queue.get()
+            if kind == "lines":
+                for line in value:
+                    yield line + "\n"
+            elif kind == "error":
+                raise value
+            else:
+                return
+    finally:
+        sink.cancelled = True
+        thread.join()
+
+
+#===== NATIVE ENGINE ===========================================================
+
+# A linked program can be translated into Python source, with one function
+# per rule (the entry point at ip 0, plus every CLL target), much like a
+# parser written by hand. That source is then compiled by Python and run
+# directly, instead of dispatching every instruction through loop().
+#
+# Branches are rebuilt as structured code. A backward branch closes a
+# 'while True:' loop around the code it jumps back over. A forward branch sets
+# 'go' to its target ip, and every run of code that a forward branch might skip
+# is guarded by 'if go < 0:', until the target clears 'go' again.
+# Labels 1 and 2 of each rule's stack frame become the locals l1 and l2.
+
+class Finished(Exception):
+    """Raised by END in native code, to unwind every rule at once"""
+    def __init__(self, switch):
+        Exception.__init__(self)
+        self.switch = switch
+
+class Unstructured(Exception):
+    """A program's branches cannot be rebuilt as nested loops"""
+    pass
+
+# Python refuses to compile more deeply nested blocks than this
+MAX_NATIVE_NESTING = 18
+
+def reachable(ops, args, entry):
+    """All ips reachable from entry without following a CLL, in order"""
+    seen = set()
+    todo = [entry]
+    while len(todo) != 0:
+        ip = todo.pop()
+        while ip < len(ops) and ip not in seen:
+            seen.add(ip)
+            op = ops[ip]
+            if op == OP_R or op == OP_END:
+                break
+            if op == OP_B:
+                ip = args[ip]
+                continue
+            if op == OP_BT or op == OP_BF:
+                todo.append(args[ip])
+            ip += 1
+    return sorted(seen)
+
+class RuleTranslator():
+    """Translates the code of one rule into the body of a Python function"""
+    def __init__(self, prog, entry, ops, args):
+        self.prog = prog
+        self.ops = ops  # from prog.plain_code()
+        self.args = args
+        self.entry = entry
+        self.ips = reachable(self.ops, self.args, entry)
+        self.lines = []
+        self.find_loops()
+
+    def find_loops(self):
+        """Find the loop closed by each backward branch, and check they nest"""
+        ops, args = self.ops, self.args
+        self.targets = set()   # ips that a forward branch goes to
+        self.loops = {}        # loop head ip -> [tail ip, ...] innermost first
+        regions = []
+        for ip in self.ips:
+            if ops[ip] in (OP_B, OP_BT, OP_BF):
+                target = args[ip]
+                if target > ip:
+                    self.targets.add(target)
+                else:
+                    regions.append((target, ip))
+                    self.loops.setdefault(target, []).append(ip)
+
+        for tails in self.loops.values():
+            tails.sort()
+        for h1, t1 in regions:
+            for h2, t2 in regions:
+                if h1 < h2 <= t1 < t2:
+                    raise Unstructured("loops %d..%d and %d..%d overlap" % (h1, t1, h2, t2))
+
+    def emit(self, depth, text):
+        if depth > MAX_NATIVE_NESTING:
+            raise Unstructured("loops nested too deeply")
+        self.lines.append("    " * depth + text)
+
+    def translate(self) -> list:
+        name = rule_name(self.prog, self.entry)
+        self.emit(1, "def rule_%d():" % self.entry)
+        self.emit(2, "# %s" % name)
+        self.emit(2, "sw = False")
+        self.emit(2, "go = -1")
+        self.emit(2, "l1 = l2 = None")
+        self.block(2, 0, len(self.ips), None)
+        self.emit(2, "m.fail('native:no way out of rule %s')" % name)
+        return self.lines
+
+    def block(self, depth, start, stop, tail):
+        """Emit ips[start:stop], with tail being the tail of an enclosing loop"""
+        ips, ops, args = self.ips, self.ops, self.args
+        guarded = False
+        i = start
+        while i < stop:
+            ip = ips[i]
+
+            if ip in self.targets:
+                self.emit(depth, "if go == %d: go = -1" % ip)
+                guarded = False
+
+            # the head of one or more loops, the outermost one is opened here
+            tails = [t for t in self.loops.get(ip, ()) if tail is None or t < tail]
+            if len(tails) != 0:
+                loop_tail = tails[-1]
+                j = ips.index(loop_tail)
+                self.emit(depth, "while True:")
+                self.block(depth+1, i, j, loop_tail)
+                self.tail(depth+1, loop_tail)
+                guarded = False
+                i = j + 1
+                continue
+
+            if not guarded:
+                self.emit(depth, "if go < 0:")
+                guarded = True
+            mark = len(self.lines)
+            if self.instr(depth+1, ip, ips[i+1] if i+1 < len(ips) else None):
+                guarded = False
+            if len(self.lines) == mark and not guarded:
+                # nothing emitted, so drop the guard just opened for it
+                if self.lines[-1].strip() == "if go < 0:":
+                    self.lines.pop()
+            i += 1
+
+    def tail(self, depth, ip):
+        """The backward branch at the end of a loop"""
+        op = self.ops[ip]
+        if ip in self.targets:
+            self.emit(depth, "if go == %d: go = -1" % ip)
+        self.emit(depth, "if go >= 0: break")
+        if op == OP_BT:
+            self.emit(depth, "if not sw: break")
+        elif op == OP_BF:
+            self.emit(depth, "if sw: break")
+
+    def instr(self, depth, ip, next_ip) -> bool:
+        """Emit one instr, returning True if it may have set go"""
+        op = self.ops[ip]
+        arg = self.args[ip]
+        emit = self.emit
+
+        if op == OP_TST:
+            emit(depth, "m.ip = %d" % (ip+1))
+            emit(depth, "sw = is_literal(%r)" % arg)
+        elif op == OP_ID:
+            emit(depth, "m.ip = %d" % (ip+1))
+            emit(depth, "sw = id()")
+        elif op == OP_NUM:
+            emit(depth, "m.ip = %d" % (ip+1))
+            emit(depth, "sw = number()")
+        elif op == OP_SR:
+            emit(depth, "m.ip = %d" % (ip+1))
+            emit(depth, "sw = dot_string()")
+        elif op == OP_CLL:
+            emit(depth, "sw = rule_%d()" % arg)
+        elif op == OP_R:
+            emit(depth, "return sw")
+            return True
+        elif op == OP_END:
+            emit(depth, "raise Finished(sw)")
+            return True
+        elif op == OP_SET:
+            emit(depth, "sw = True")
+        elif op == OP_B:
+            # backward branches only ever close loops, see tail()
+            if arg != next_ip:
+                emit(depth, "go = %d" % arg)
+            return True
+        elif op == OP_BT:
+            emit(depth, "if sw: go = %d" % arg)
+            return True
+        elif op == OP_BF:
+            emit(depth, "if not sw: go = %d" % arg)
+            return True
+        elif op == OP_BE:
+            emit(depth, "if not sw: be(%d)" % (ip+1))
+        elif op == OP_CL:
+            emit(depth, "dot_out(%r)" % arg)
+        elif op == OP_CI:
+            emit(depth, "dot_out(r.saved)")
+        elif op == OP_OUT:
+            emit(depth, "out()")
+        elif op == OP_GN1:
+            emit(depth, "if l1 is None: l1 = nextlabel(1)")
+            emit(depth, "dot_out(l1)")
+        elif op == OP_GN2:
+            emit(depth, "if l2 is None: l2 = nextlabel(2)")
+            emit(depth, "dot_out(l2)")
+        elif op == OP_LB:
+            emit(depth, "to_label()")
+
+        if next_ip != ip+1:
+            # falls off the end of the program
+            emit(depth, "m.ip = %d" % (ip+1))
+            emit(depth, "m.fail('native:ran off the end of the program')")
+        return False
+
+def rule_name(prog, ip):
+    """The first label of ip, for comments and messages"""
+    for label, label_ip in prog.label_to_ip.items():
+        if label_ip == ip:
+            return label
+    return "ip %d" % ip
+
+def translate(prog) -> str:
+    """Translate a linked Program into Python source, one function per rule"""
+    ops, args = prog.plain_code()
+    entries = set([0])
+    for ip in range(len(ops)):
+        if ops[ip] == OP_CLL:
+            entries.add(args[ip])
+
+    lines = [
+        "# Translated from a META-II VM program by meta.py",
+        "",
+        "def bind(m):",
+        "    r = m.reader",
+        "    is_literal = r.is_literal",
+        "    id = r.id",
+        "    number = r.number",
+        "    dot_string = r.dot_string",
+        "    dot_out = m.dot_out",
+        "    out = m.out",
+        "    to_label = m.to_label",
+        "    nextlabel = m.nextlabel",
+        "",
+        "    def be(ip):",
+        "        m.ip = ip",
+        "        m.fail('BE:branch to error executed', m.prog.format_instrs())",
+        "",
+    ]
+    for entry in sorted(entries):
+        lines += RuleTranslator(prog, entry, ops, args).translate()
+        lines.append("")
+    lines.append("    return rule_0")
+    return "\n".join(lines) + "\n"
+
+def compile_native(prog, filename="<meta>") -> bool:
+    """Translate prog to Python and compile it, so that it runs natively.
+
+    Returns False, leaving prog to run on loop(), if its branches do not
+    form properly nested loops.
+    """
+    try:
+        source = translate(prog)
+    except Unstructured as e:
+        sys.stderr.write("%s: cannot translate to Python (%s), using the VM\n" % (filename, str(e)))
+        return False
+
+    # not the .meta file, which the translation's line numbers are not from
+    name = "<native:%s>" % os.path.basename(filename)
+    bind_native(prog, compile(source, name, "exec"))
+    return True
+
+def bind_native(prog, code):
+    """Attach the compiled translation of prog to it"""
+    namespace = {"Finished": Finished}
+    exec(code, namespace)
+    prog.native_code = code
+    prog.native = namespace["bind"]
+
+
+#----- PROGRAM CACHE -----------------------------------------------------------
+
+# Linked programs, and their native translations, are kept on disk so that
+# loading one again is a single read and unpickle. Entries are keyed by a hash
+# of the program text, of the Python version and of metaii.py itself, so an
+# edited program, a different Python or an edited engine simply gets a new
+# entry. The least recently used entries
+# are removed once the cache grows past CACHE_MAX_BYTES.
+
+CACHE_VERSION   = 4  # for old entries; a change to metaii.py changes every key
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+source_digest = None  # of metaii.py itself, see engine_digest()
+
+def engine_digest() -> bytes:
+    """Hash of the source of metaii.py, so that editing it misses the cache"""
+    global source_digest
+    if source_digest is None:
+        import hashlib
+        with open(os.path.abspath(__file__), "rb") as f:
+            source_digest = hashlib.sha256(f.read()).digest()
+    return source_digest
+
+def cache_dir():
+    """$META_CACHE_DIR, else meta-compiler in the user's cache directory"""
+    cachedir = os.environ.get("META_CACHE_DIR")
+    if cachedir is None:
+        base = os.environ.get("XDG_CACHE_HOME")
+        if not base:
+            base = os.path.join(os.path.expanduser("~"), ".cache")
+        cachedir = os.path.join(base, "meta-compiler")
+    return cachedir
+
+def cache_key(data, native):
+    """Hash of the program text, the Python version, the cache format and engine"""
+    import hashlib
+    h = hashlib.sha256()
+    h.update(("meta.py:%d:%s:%s\n" % (CACHE_VERSION,
+        sys.implementation.cache_tag, native)).encode())
+    h.update(engine_digest())
+    h.update(data)
+    return h.hexdigest()
+
+def load_program_cached(filename, native=False, cachedir=None) -> Program:
+    """load_program() (and compile_native()), through the on-disk cache"""
+    with open(filename, "rb") as f:
+        data = f.read()
+    return load_program_data(data, filename, native, cachedir)
+
+def load_program_data(data, filename, native=False, cachedir=None) -> Program:
+    """load_program_cached() for a program already read in from filename"""
+    if cachedir is None:
+        cachedir = cache_dir()
+    path = os.path.join(cachedir, cache_key(data, native) + ".pickle")
+
+    prog = cache_fetch(path)
+    if isinstance(prog, Program):
+        return prog
+
+    prog = Program()
+    prog.load_instrs(io.TextIOWrapper(io.BytesIO(data)))
+    prog.link()
+    if native:
+        compile_native(prog, filename)
+    cache_store(cachedir, path, prog)
+    return prog
+
+def cache_fetch(path):
+    """What a cache entry holds, or None if there is no readable entry"""
+    import pickle
+    try:
+        with open(path, "rb") as f:
+            entry = pickle.load(f)
+        os.utime(path)  # now the most recently used
+        return entry
+    except Exception:
+        return None  # missing, unreadable or stale, so it will be replaced
+
+def cache_store(cachedir, path, entry):
+    """Write a cache entry, then trim the cache back to size"""
+    # The cache is only ever an optimisation, so failing to write is ignored.
+    import pickle
+    try:
+        os.makedirs(cachedir, exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)  # so that readers never see half an entry
+        cache_evict(cachedir)
+    except OSError:
+        pass
+
+def cache_evict(cachedir, max_bytes=CACHE_MAX_BYTES):
+    """Remove least recently used entries until the cache fits in max_bytes"""
+    entries = []
+    for name in os.listdir(cachedir):
+        if name.endswith(".pickle"):
+            path = os.path.join(cachedir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(e[1] for e in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def get_program(spec_name, native=False, cache=True) -> Program:
+    """Load the program for a compilation, the way the command line asked"""
+    if cache:
+        return load_program_cached(spec_name, native)
+    prog = load_program(spec_name)
+    if native:
+        compile_native(prog, spec_name)
+    return prog
+
+
+#----- BOOTSTRAP ---------------------------------------------------------------
+
+# bootstrap() compiles a grammar of META-II (meta.spec) with the built-in
+# compiler, then with that output, and so on, until two generations in a
+# row are the same: that fixpoint is a META-II that compiles itself. Every
+# stage runs on the same machine, and each one's lines of output are loaded
+# straight into the next one's program.
+#
+# The output of every stage is kept in the program cache, keyed by a hash of
+# the program, of the grammar and of metaii.py itself, so that bootstrapping an
+# unchanged grammar again only has to look up each stage, and runs none of
+# them, while any edit to the engine runs them all again.
+
+BOOTSTRAP_GENERATIONS = 10  # generations tried before giving up on a fixpoint
+
+class LineSink(OutputSink):
+    """An OutputSink that keeps all of its lines, instead of writing them"""
+    def __init__(self):
+        OutputSink.__init__(self, None)
+
+    def flush(self):
+        pass
+
+def stage_key(prog_text, spec) -> str:
+    """Hash of the program and the grammar of a bootstrap stage, and the engine"""
+    import hashlib
+    h = hashlib.sha256()
+    h.update(("meta.py:%d:bootstrap\n" % CACHE_VERSION).encode())
+    h.update(engine_digest())
+    h.update(hashlib.sha256(prog_text.encode()).digest())
+    h.update(spec.encode())
+    return h.hexdigest()
+
+def bootstrap(spec, cache=True, limit=BOOTSTRAP_GENERATIONS):
+    """Compile spec with its own output until that no longer changes.
+
+    Returns the fixpoint, as text, and a list with an entry for each
+    generation compiled, True if it came from the cache.
+    """
+    machine = MetaMachine()
+    cachedir = cache_dir()
+    prog_text = META_II + "\n"  # as written out, with its blank last line
+    prog_lines = None  # of the generation before, None for the built-in
+    stages = []
+
+    while len(stages) < limit:
+        path = os.path.join(cachedir, stage_key(prog_text, spec) + ".pickle")
+        lines = None
+        if cache:
+            lines = cache_fetch(path)
+            if not isinstance(lines, list):
+                lines = None
+        stages.append(lines is not None)
+
+        if lines is None:
+            prog = None
+            if prog_lines is not None:
+                prog = Program()
+                prog.load_lines(prog_lines)
+                prog.link()
+            sink = LineSink()
+            try:
+                machine.run(prog, io.StringIO(spec), sink)
+            except MetaError as e:
+                raise MetaError("bootstrap:generation %d failed\n%s" %
+                                (len(stages), str(e)))
+            lines = sink.lines
+            if cache:
+                cache_store(cachedir, path, lines)
+
+        text = "".join(line + "\n" for line in lines)
+        if text == prog_text:
+            return text, stages
+        prog_text = text
+        prog_lines = lines
+
+    raise MetaError("bootstrap:no fixpoint after %d generations\n" % limit)
+
+
+#----- PARALLEL SPLIT ----------------------------------------------------------
+
+# compile_split() shares one large input out over worker processes, at the
+# calls of a rule made in a $ loop, such as each ST of a VALGOL BLOCK. A
+# quick scan cuts the input into chunks at line starts where the loop could
+# go on (the next non-blank character is in the FIRST set of its body), and
+# each worker runs the loop from the start of its chunk, remembering every
+# call of the rule that it makes there, as the packrat machine does.
+#
+# Meanwhile this process compiles the input from the start, as usual. When
+# it calls the rule in just the state that a worker did (the same input
+# position, saved text and switch) it replays the worker's result instead,
+# renumbering its labels to follow on from those generated before it. So
+# the output is exactly that of compiling it all in one go. A chunk that
+# was cut in the wrong place only means that some calls are not replayed.
+# Workers hand each output line of a call that has no label in it over
+# ready made, so that replaying it is no more than writing it out.
+
+SPLIT_CHUNK_CHARS = 65536  # smallest chunk worth giving to a worker
+SPLIT_CHUNKS      = 4      # chunks for each worker, at most
+
+LINE_START_RE = re.compile(r"\n[ \t\r]*([^ \t\r\n])")
+
+class ChunkDone(Exception):
+    """Stops a SplitWorker, at the end of its chunk or at a syntax error"""
+
+def split_loop(prog, name):
+    """(ip of rule name, ip of the first $ loop that calls it) or None"""
+    rule = prog.label_to_ip.get(name)
+    if rule is None:
+        return None
+    ops, args = prog.plain_code()
+    for ip in range(len(ops)):
+        if ops[ip] == OP_CLL and args[ip] == rule:
+            # the innermost loop around it ends in the first BT back over it
+            for end in range(ip + 1, len(ops)):
+                if ops[end] == OP_BT and args[end] <= ip:
+                    return rule, args[end]
+    return None
+
+def split_points(text, first, chunks) -> list:
+    """Where each chunk of text starts: 0, then line starts spread evenly,
+    each one where the next non-blank character is in first (if not None)"""
+    starts = [0]
+    size = len(text) // chunks
+    for k in range(1, chunks):
+        for m in LINE_START_RE.finditer(text, max(k * size - 1, starts[-1])):
+            if m.start() >= (k + 1) * size:
+                break
+            if first is None or m.group(1) in first:
+                starts.append(m.start() + 1)
+                break
+    return starts
+
+class SplitWorker(PackratMachine):
+    """Runs the loop of compile_split() over one chunk of the input"""
+    follow_calls = True
+
+    def __init__(self, rule):
+        PackratMachine.__init__(self)
+        self.rule = rule
+        self.end = 0
+        self.results = []
+
+    def compile_chunk(self, prog, text, head, start, end) -> list:
+        """((rule, position, saved, switch), result) of every call of the
+        rule that starts in text[start:end]"""
+        self.prog = prog
+        self.names = {}
+        self.reset(io.StringIO(text), io.StringIO())
+        self.end = end
+        self.results = []
+        self.reader.skip_to(start, "")
+        try:
+            self.loop(head)
+        except (ChunkDone, MetaError):
+            # the end of the chunk, or of the loop, or a chunk that did not
+            # start where the loop goes on: in any case the results so far
+            # are still right, and the rest is left to compile_split()
+            pass
+        except (TypeError, AttributeError):
+            # the same, where the lexer ran into the end of the input, which
+            # peek() gives it as None; anything else is a real error
+            if self.reader.cache is not None:
+                raise
+        return self.results
+
+    def call(self, ip, rule, switch):
+        if rule != self.rule or len(self.stack) != 0:
+            return MetaMachine.call(self, ip, rule, switch)
+        reader = self.reader
+        if reader.tell() >= self.end:
+            raise ChunkDone()
+        key = (rule, reader.tell(), reader.saved, switch)
+        self.marks.append((key, len(self.log), self.counters()))
+        return MetaMachine.call(self, ip, rule, switch)
+
+    def ret(self, switch):
+        ip = MetaMachine.ret(self, switch)
+        if len(self.stack) == 0 and len(self.marks) != 0:
+            key, log_len, labels = self.marks.pop()
+            reader = self.reader
+            self.results.append((key, (switch, reader.tell(), reader.saved,
+                                       render_log(self.log), labels,
+                                       self.counters())))
+            self.log = []
+        return ip
+
+    def rule_error(self):
+        raise ChunkDone()
+
+def render_log(log) -> list:
+    """A call's log, as its output lines: those with no labels made up, and
+    the rest (and the first, which may go on from the caller's) left as
+    lists of log entries"""
+    lines = []
+    line = []
+    for e in log:
+        line.append(e)
+        if type(e) is int and e == LOG_OUT:
+            parts = line[:-1]
+            if len(lines) != 0 and all(type(p) is str for p in parts):
+                lines.append(INSTR_INDENT + "".join(parts).strip())
+            else:
+                lines.append(line)
+            line = []
+    if len(line) != 0:
+        lines.append(line)
+    return lines
+
+class SplitMachine(PackratMachine):
+    """Compiles the whole input, replaying the calls that workers made"""
+    follow_calls = True
+    cache_scans = False  # it never backtracks over the input
+
+    def __init__(self, rule, flush_lines=OUTPUT_CHUNK):
+        PackratMachine.__init__(self, flush_lines)
+        self.rule = rule
+        self.pending = []  # (start, future results) of each chunk, in order
+        self.results = {}  # of the chunks started so far
+
+    def call(self, ip, rule, switch):
+        if rule == self.rule:
+            reader = self.reader
+            pos = reader.tell()
+            pending = self.pending
+            while len(pending) != 0 and pending[0][0] <= pos:
+                self.results.update(pending.pop(0)[1].result())
+            result = self.results.pop((rule, pos, reader.saved, switch), None)
+            if result is not None:
+                return ip, self.replay(result)
+        return MetaMachine.call(self, ip, rule, switch)
+
+    def ret(self, switch):
+        return MetaMachine.ret(self, switch)
+
+    def rule_error(self):
+        return MetaMachine.rule_error(self)
+
+    def replay(self, result) -> bool:
+        """Repeat a worker's call, from its output lines (see render_log())"""
+        switch, pos, saved, lines, before, after = result
+        self.reader.skip_to(pos, saved)
+
+        now = self.counters()
+        shift = (now[0] - before[0], now[1] - before[1])
+        write_line = self.sink.write_line
+        for line in lines:
+            if type(line) is str:
+                write_line(line)
+                continue
+            for e in line:
+                if type(e) is tuple:
+                    e = (e[0], e[1] + shift[e[0]])
+                self.emit(e)
+        self.labels[:] = (after[0] + shift[0], after[1] + shift[1])
+        return switch
+
+def init_split_worker(prog, text, rule, head):
+    """Set up a worker process, once, with the program and the whole input"""
+    global worker
+    worker = (SplitWorker(rule), prog, text, head)
+
+def worker_compile_chunk(chunk):
+    machine, prog, text, head = worker
+    return machine.compile_chunk(prog, text, head, chunk[0], chunk[1])
+
+def compile_split(prog, rule_name, infile, outfile, jobs) -> None:
+    """Compile infile, writing to outfile, with the calls of rule_name in a
+    $ loop shared out over jobs worker processes"""
+    if prog is None:
+        prog = builtin_program()
+    loop = split_loop(prog, rule_name)
+    if loop is None:
+        fail("split:%s is not a rule called in a $ loop" % rule_name)
+    rule, head = loop
+    text = infile.read()
+    ops, args = prog.plain_code()
+    first = FirstSets(ops, args).test(head)
+    chunks = min(jobs * SPLIT_CHUNKS, len(text) // SPLIT_CHUNK_CHARS)
+    starts = split_points(text, first, max(1, chunks))
+
+    machine = SplitMachine(rule)
+    if len(starts) == 1:
+        machine.run(prog, io.StringIO(text), outfile)
+        return
+    ends = starts[1:] + [len(text)]
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+            initializer=init_split_worker,
+            initargs=(prog, text, rule, head)) as pool:
+        # this process compiles the first chunk itself
+        machine.pending = [(start, pool.submit(worker_compile_chunk, chunk))
+                           for start, chunk in zip(starts[1:],
+                                                   zip(starts[1:], ends[1:]))]
+        try:
+            machine.run(prog, io.StringIO(text), outfile)
+        finally:
+            for start, future in machine.pending:
+                future.cancel()
+
+
+#----- COMPILE SERVER ----------------------------------------------------------
+
+# meta.py --serve stays running and compiles whatever its clients send it, so
+# that they do not each pay for starting Python and loading their program.
+# It listens on a Unix socket, or on HOST:PORT, and every request, and every
+# response, is one line of JSON:
+#
+#   {"prog": "/abs/valgol1.meta", "source": "...", "native": false,
+#    "packrat": false, "line_comment": "//", "block_comment": null, "id": 1}
+#   {"ok": true, "output": "...", "hash": "<sha256 of the program>", "id": 1}
+#
+# A client can give the "hash" instead of the "prog", for a program that the
+# server has seen recently; with neither, the built-in META-II compiler is
+# used. Only "source" is needed. When a compilation fails, "ok" is false,
+# "error" says why and "output" is whatever was written before it. The
+# requests on one connection are answered in the order they were sent.
+#
+# An asyncio front end reads the requests and hands the compilations to a
+# pool of worker processes. Each worker keeps the SERVE_PROGRAMS programs it
+# has used most recently loaded and linked, and the front end keeps their
+# text, for requests that only give a hash.
+#
+# asyncio (and signal) are imported by the functions that use them, as
+# importing asyncio would add tens of milliseconds to the start up of every
+# other run of meta.py.
+
+SERVE_PROGRAMS   = 16       # programs kept loaded, least recently used go first
+SERVE_LINE_LIMIT = 1 << 30  # longest request line
+
+def serve_address() -> str:
+    """$META_SERVER, else a Unix socket in the cache directory"""
+    address = os.environ.get("META_SERVER")
+    if not address:
+        address = os.path.join(cache_dir(), "server.sock")
+    return address
+
+def tcp_address(address):
+    """(host, port) of a HOST:PORT address, or None for a Unix socket path"""
+    host, sep, port = address.rpartition(":")
+    if sep == "" or not port.isdigit() or "/" in address:
+        return None
+    return (host or "localhost", int(port))
+
+# The loaded programs, machines and cache setting of a --serve worker process
+served = None
+
+def init_serve_worker(cache):
+    global served
+    served = (collections.OrderedDict(), {}, cache)
+
+def served_program(key, data, name, native) -> Program:
+    """The program with this hash, loading it unless it is already loaded"""
+    programs, machines, cache = served
+    prog = programs.get((key, native))
+    if prog is not None:
+        programs.move_to_end((key, native))
+        return prog
+
+    if cache:
+        prog = load_program_data(data, name, native)
+    else:
+        prog = Program()
+        prog.load_instrs(io.TextIOWrapper(io.BytesIO(data)))
+        prog.link()
+        if native:
+            compile_native(prog, name)
+    programs[(key, native)] = prog
+    if len(programs) > SERVE_PROGRAMS:
+        programs.popitem(last=False)
+    return prog
+
+def serve_compile(job):
+    """Run one --serve compilation, returning (output, None or a report)"""
+    key, data, name, native, packrat, comments, source = job
+    programs, machines, cache = served
+    output = io.StringIO()
+    try:
+        prog = None
+        if key is not None:
+            prog = served_program(key, data, name, native)
+            prog.line_comment, prog.block_comment = comments
+        machine = machines.get(packrat)
+        if machine is None:
+            machine = machines[packrat] = new_machine(packrat)
+        machine.run(prog, io.StringIO(source), output)
+    except MetaError as e:
+        return output.getvalue(), str(e)
+    except Exception as e:
+        return output.getvalue(), "%s:%s\n" % (type(e).__name__, str(e))
+    return output.getvalue(), None
+
+class CompileServer():
+    """The asyncio front end of meta.py --serve"""
+    def __init__(self, pool):
+        self.pool = pool
+        self.loop = None
+        self.programs = collections.OrderedDict()  # hash -> (name, text)
+
+    async def serve(self, address):
+        """Accept connections on address until the server is closed"""
+        import asyncio, signal
+        tcp = tcp_address(address)
+        if tcp is None:
+            await self.check_unused(address)
+            os.makedirs(os.path.dirname(os.path.abspath(address)),
+                        exist_ok=True)
+            server = await asyncio.start_unix_server(self.handle, address,
+                                                     limit=SERVE_LINE_LIMIT)
+        else:
+            server = await asyncio.start_server(self.handle, tcp[0], tcp[1],
+                                                limit=SERVE_LINE_LIMIT)
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_signal_handler(signal.SIGTERM, server.close)
+        sys.stderr.write("meta.py: serving on %s\n" % address)
+        sys.stderr.flush()
+
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if tcp is None and os.path.exists(address):
+                os.remove(address)
+
+    async def check_unused(self, path):
+        """Fail if another server is listening on the Unix socket path"""
+        # start_unix_server() replaces a socket left behind by a server that
+        # has stopped, but would also replace that of a running one.
+        import asyncio
+        if not os.path.exists(path):
+            return
+        try:
+            reader, writer = await asyncio.open_unix_connection(path)
+        except OSError:
+            return
+        writer.close()
+        raise OSError("another server is listening on it")
+
+    async def handle(self, reader, writer):
+        """Answer each request on one connection, in turn"""
+        import json
+        try:
+            while True:
+                line = await reader.readline()
+                if len(line) == 0:
+                    break
+                response = await self.respond(line)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass  # the client went away, or sent a line that was too long
+        finally:
+            writer.close()
+
+    async def respond(self, line) -> dict:
+        """The response to one request line"""
+        import json
+        request = {}
+        try:
+            request = json.loads(line)
+            key, data, name = self.program(request)
+            comments = (request.get("line_comment"),
+                        request.get("block_comment"))
+            if comments[1] is not None:
+                comments = (comments[0], tuple(comments[1]))
+            job = (key, data, name, bool(request.get("native")),
+                   bool(request.get("packrat")), comments, request["source"])
+        except (ValueError, LookupError, TypeError, AttributeError,
+                OSError) as e:
+            response = {"ok": False, "error": "bad request:%s\n" % str(e)}
+        else:
+            output, error = await self.loop.run_in_executor(self.pool,
+                                                            serve_compile, job)
+            response = {"ok": error is None, "output": output, "hash": key}
+            if error is not None:
+                response["error"] = error
+
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+        return response
+
+    def program(self, request):
+        """(hash, text, name) of the program a request asks for"""
+        import hashlib
+        if request.get("prog") is not None:
+            name = request["prog"]
+            with open(name, "rb") as f:
+                data = f.read()
+            key = hashlib.sha256(data).hexdigest()
+        elif request.get("hash") is not None:
+            key = request["hash"]
+            if key not in self.programs:
+                raise ValueError("no program with hash %s" % key)
+            name, data = self.programs[key]
+        else:
+            return None, None, None
+
+        self.programs[key] = (name, data)
+        self.programs.move_to_end(key)
+        if len(self.programs) > SERVE_PROGRAMS:
+            self.programs.popitem(last=False)
+        return key, data, name
+
+def meta2_serve(address, jobs=1, cache=True):
+    """Serve compilations on address, until interrupted or terminated"""
+    import asyncio, concurrent.futures
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                initializer=init_serve_worker, initargs=(cache,)) as pool:
+            asyncio.run(CompileServer(pool).serve(address))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        sys.stderr.write("meta.py: cannot serve on %s: %s\n" % (address, e))
+        exit(1)
+
+
+#----- RUNNABLE TOOL -----------------------------------------------------------
+
+def report(e):
+    """Report a MetaError the way the command line tool always has"""
+    print()
+    sys.stderr.write(str(e))
+
+def meta2_py(f, flush_lines=OUTPUT_CHUNK, profile=False, stacks_name=None):
+    machine = new_machine(False, flush_lines, profile)
+    try:
+        machine.run(None, f, sys.stdout)
+    except MetaError as e:
+        report(e)
+        exit(1)
+    finally:
+        report_profile(machine, stacks_name)
+
+def new_machine(packrat=False, flush_lines=OUTPUT_CHUNK, profile=False) -> MetaMachine:
+    if packrat:
+        return PackratMachine(flush_lines)
+    if profile:
+        return ProfilingMachine(flush_lines)
+    return MetaMachine(flush_lines)
+
+def report_profile(machine, stacks_name):
+    """Write out what a ProfilingMachine found, if it is one"""
+    if isinstance(machine, ProfilingMachine):
+        machine.write_report(sys.stderr)
+        if stacks_name is not None:
+            with open(stacks_name, "w") as f:
+                machine.write_collapsed(f)
+
+def meta2_vm(spec_name, f, native=False, cache=True, flush_lines=OUTPUT_CHUNK,
+             packrat=False, profile=False, stacks_name=None, comments=(None, None)):
+    machine = new_machine(packrat, flush_lines, profile)
+    try:
+        prog = get_program(spec_name, native, cache)
+        prog.line_comment, prog.block_comment = comments
+        machine.run(prog, f, sys.stdout)
+    except MetaError as e:
+        report(e)
+        exit(1)
+    finally:
+        report_profile(machine, stacks_name)
+
+def split_program(spec_name, cache=True, comments=(None, None)):
+    """The program to --split with: spec_name, or the built-in compiler"""
+    if spec_name is None:
+        return builtin_program()
+    try:
+        prog = get_program(spec_name, False, cache)
+    except MetaError as e:
+        report(e)
+        exit(1)
+    prog.line_comment, prog.block_comment = comments
+    return prog
+
+def meta2_split(prog, f, rule, jobs=1, flush_lines=OUTPUT_CHUNK):
+    try:
+        compile_split(prog, rule, f, OutputSink(sys.stdout, flush_lines), jobs)
+    except MetaError as e:
+        report(e)
+        exit(1)
+
+def meta2_emit_python(spec_name):
+    try:
+        prog = load_program(spec_name)
+        sys.stdout.write(translate(prog))
+    except (MetaError, Unstructured) as e:
+        report(e)
+        exit(1)
+
+def meta2_bootstrap(spec_name, cache=True):
+    try:
+        with open(spec_name) as file:
+            spec = file.read()
+        text, stages = bootstrap(spec, cache)
+    except MetaError as e:
+        report(e)
+        exit(1)
+    sys.stdout.write(text)
+    sys.stderr.write("%s: fixpoint at generation %d (%d from the cache)\n" %
+                     (spec_name, len(stages), stages.count(True)))
+
+def meta2_optimize(spec_name):
+    try:
+        prog = Program()
+        with open(spec_name) as file:
+            prog.load_instrs(file)
+        before = len(prog.instrs)
+        counts = optimize(prog)
+        prog.write_instrs(sys.stdout)
+    except MetaError as e:
+        report(e)
+        exit(1)
+    report_optimize(spec_name, before, len(prog.instrs), counts)
+
+def report_optimize(spec_name, before, after, counts):
+    """Write how much optimize() took out of a program to stderr"""
+    saved = 0.0
+    if before != 0:
+        saved = (before - after) * 100.0 / before
+    sys.stderr.write("%s: %d -> %d instructions (-%.1f%%)\n" % (spec_name,
+                     before, after, saved))
+    for what, n in sorted(counts.items()):
+        sys.stderr.write("  %5d %s\n" % (n, what))
+
+def batch_output_name(filename, outdir, suffix):
+    """x/y/name.ext -> outdir/name<suffix>"""
+    base = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(outdir, base + suffix)
+
+def compile_file(machine, prog, filename, outname, mapped=False):
+    """Compile one file of a batch, returning None or a failure report"""
+    # On failure any stale output is removed, so that make will not think
+    # it is up to date.
+    try:
+        with open(filename) as f:
+            input = f
+            if mapped:
+                input = map_input(f)
+            output = machine.compile(prog, input)
+    except MetaError as e:
+        error = str(e)
+    except Exception as e:
+        error = "%s:%s\n" % (type(e).__name__, str(e))
+    else:
+        with open(outname, "w") as f:
+            f.write(output)
+        return None
+
+    if os.path.exists(outname):
+        os.remove(outname)
+    return error
+
+# The loaded program and machine of a --jobs worker process
+worker = None
+
+def init_worker(prog, packrat, mapped):
+    """Set up a worker process, once, with an already linked program"""
+    global worker
+    worker = (new_machine(packrat), prog, mapped)
+
+def worker_compile_file(names):
+    machine, prog, mapped = worker
+    return compile_file(machine, prog, names[0], names[1], mapped)
+
+def meta2_batch(spec_name, filenames, outdir, suffix, jobs=1, native=False,
+                cache=True, packrat=False, mapped=False,
+                comments=(None, None)) -> bool:
+    """Compile many files with one loaded program, reporting on each one"""
+    # A failing file does not stop the batch.
+    # With jobs > 1 the files are shared out over a pool of worker
+    # processes. The program is loaded and linked once, here, and each worker
+    # receives the linked (and translated) form when it starts. Reports are
+    # written by this process, one file at a time and in the order the files
+    # were given.
+    try:
+        prog = get_program(spec_name, native, cache)
+        prog.line_comment, prog.block_comment = comments
+    except MetaError as e:
+        report(e)
+        return False
+
+    names = [(f, batch_output_name(f, outdir, suffix)) for f in filenames]
+
+    if jobs <= 1 or len(names) <= 1:
+        machine = new_machine(packrat)
+        results = (compile_file(machine, prog, f, o, mapped) for f, o in names)
+        return report_batch(names, results)
+
+    chunksize = max(1, len(names) // (jobs * 4))
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+            initializer=init_worker, initargs=(prog, packrat, mapped)) as pool:
+        results = pool.map(worker_compile_file, names, chunksize=chunksize)
+        return report_batch(names, results)
+
+def report_batch(names, results) -> bool:
+    """Write an ok/FAILED report for each file, in order"""
+    all_ok = True
+    for (filename, outname), error in zip(names, results):
+        if error is None:
+            sys.stderr.write("ok:%s -> %s\n" % (filename, outname))
+        else:
+            all_ok = False
+            sys.stderr.write("FAILED:%s\n" % filename)
+            sys.stderr.write(error)
+        sys.stderr.flush()
+    return all_ok
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="meta.py",
+        description="An interpreter for the META-II virtual machine",
+        epilog="With no <prog>, the built-in META-II compiler is used. "
+               "Without --batch, the input is read from stdin "
+               "and the output is written to stdout.")
+    parser.add_argument("prog", nargs="?",
+        help="META-II VM program (.meta) to parse the input with")
+    parser.add_argument("inputs", nargs="*",
+        help="source files to compile (only with --batch)")
+    parser.add_argument("--batch", action="store_true",
+        help="load <prog> once and compile every input file with it")
+    parser.add_argument("-o", "--outdir", default=".",
+        help="directory for --batch outputs (default: .)")
+    parser.add_argument("--suffix", default=".out",
+        help="replaces the extension of each --batch input (default: .out)")
+    parser.add_argument("--native", action="store_true",
+        help="translate <prog> to Python and run that, instead of the VM")
+    parser.add_argument("--emit-python", action="store_true",
+        help="just write out the Python translation of <prog>")
+    parser.add_argument("--bootstrap", metavar="SPEC",
+        help="compile SPEC, a META-II grammar of META-II, with its own output "
+             "until that stops changing, and write out the fixpoint")
+    parser.add_argument("--optimize", action="store_true",
+        help="just write out <prog> with peephole optimizations applied")
+    parser.add_argument("--packrat", action="store_true",
+        help="backtrack rules that fail part way through, "
+             "and memoize rule calls (runs on the VM)")
+    parser.add_argument("--profile", action="store_true",
+        help="write a profile of the grammar rules to stderr")
+    parser.add_argument("--profile-stacks", metavar="FILE",
+        help="also write the profiled rule stacks to FILE, "
+             "collapsed for a flamegraph (implies --profile)")
+    parser.add_argument("--mmap", action="store_true",
+        help="map each input file into memory and scan it as bytes "
+             "(stdin too, unless it is a pipe, which is read as usual)")
+    parser.add_argument("--line-comment", metavar="PREFIX",
+        help="skip comments from PREFIX to the end of the line in the input, "
+             "as if they were whitespace")
+    parser.add_argument("--block-comment", nargs=2, metavar=("START", "END"),
+        help="skip comments from START to END in the input, "
+             "as if they were whitespace")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+        help="do not use the on-disk cache of loaded programs "
+             "(kept in $META_CACHE_DIR, default ~/.cache/meta-compiler)")
+    parser.add_argument("--flush-lines", type=int, default=OUTPUT_CHUNK,
+        metavar="N", help="write the output out every N lines "
+                          "(default: %d, 1 for every line)" % OUTPUT_CHUNK)
+    parser.add_argument("--split", metavar="RULE",
+        help="share a large input out over -j worker processes, at the "
+             "calls of RULE in a $ loop (such as ST in valgol1.meta)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="compile --batch inputs, --serve requests or --split chunks in "
+             "JOBS worker processes (implies --batch without --serve or "
+             "--split, 0 means one per cpu)")
+    parser.add_argument("--serve", nargs="?", const="", metavar="ADDRESS",
+        help="stay running, and compile what clients (metac.py) send to a "
+             "Unix socket or HOST:PORT (default: $META_SERVER, "
+             "else server.sock in the cache directory)")
+    opts = parser.parse_args(argv)
+    if opts.flush_lines < 1:
+        parser.error("--flush-lines must be at least 1")
+
+    if opts.jobs != 1 and opts.serve is None and opts.split is None:
+        opts.batch = True
+    if opts.jobs <= 0:
+        opts.jobs = os.cpu_count() or 1
+    if opts.profile_stacks is not None:
+        opts.profile = True
+    if opts.profile:
+        if opts.batch or opts.native or opts.packrat:
+            parser.error("--profile is only for a single compilation on the "
+                         "VM or the built-in compiler")
+    if opts.block_comment is not None:
+        opts.block_comment = tuple(opts.block_comment)
+    comments = (opts.line_comment, opts.block_comment)
+    if comments != (None, None) and opts.prog is None:
+        parser.error("--line-comment and --block-comment need a <prog>")
+    if opts.bootstrap is not None and (opts.prog is not None or opts.batch):
+        parser.error("--bootstrap takes no <prog>")
+    if opts.split is not None:
+        if (opts.batch or opts.native or opts.packrat or opts.profile or
+                opts.mmap):
+            parser.error("--split is only for a single compilation on the VM, "
+                         "without --mmap")
+    if opts.optimize and opts.prog is None:
+        parser.error("--optimize needs a <prog>")
+    if opts.emit_python and opts.prog is None:
+        parser.error("--emit-python needs a <prog>")
+    if opts.packrat:
+        if opts.prog is None:
+            parser.error("--packrat needs a <prog>")
+        if opts.native:
+            parser.error("--packrat runs on the VM, so not with --native")
+
+    if opts.serve is not None:
+        if (opts.prog is not None or opts.batch or opts.emit_python or
+                opts.optimize or opts.profile or opts.native or opts.packrat or
+                opts.mmap or comments != (None, None)):
+            parser.error("--serve takes its programs and options from "
+                         "each request, not the command line")
+        meta2_serve(opts.serve or serve_address(), opts.jobs, opts.cache)
+
+    elif opts.batch:
+        if opts.prog is None:
+            parser.error("--batch needs a <prog> and some input files")
+        if not meta2_batch(opts.prog, opts.inputs, opts.outdir, opts.suffix,
+                           opts.jobs, opts.native, opts.cache, opts.packrat,
+                           opts.mmap, comments):
+            exit(1)
+
+    elif len(opts.inputs) != 0:
+        parser.error("input files are only allowed with --batch")
+
+    elif opts.bootstrap is not None:
+        meta2_bootstrap(opts.bootstrap, opts.cache)
+
+    elif opts.emit_python:
+        meta2_emit_python(opts.prog)
+
+    elif opts.optimize:
+        meta2_optimize(opts.prog)
+
+    elif opts.split is not None:
+        prog = split_program(opts.prog, opts.cache, comments)
+        if split_loop(prog, opts.split) is None:
+            parser.error("--split %s is not a rule called in a $ loop"
+                         % opts.split)
+        meta2_split(prog, sys.stdin, opts.split, opts.jobs, opts.flush_lines)
+
+    else:
+        infile = sys.stdin
+        if opts.mmap:
+            infile = map_input(sys.stdin)
+
+        if opts.prog is None:
+            # m2
+            meta2_py(infile, opts.flush_lines, opts.profile, opts.profile_stacks)
+        else:
+            # m2 <prog>
+            meta2_vm(opts.prog, infile, opts.native, opts.cache,
+                     opts.flush_lines, opts.packrat, opts.profile,
+                     opts.profile_stacks, comments)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+# END